@@ -9,6 +9,7 @@ from pathlib import Path
 from platformdirs import user_config_dir
 from gpohound.utils.utils import load_yaml_config
 from gpohound.core import GPOHoundCore
+from gpohound.exporter import EnrichmentExporter
 
 
 def main():
@@ -60,6 +61,77 @@ def main():
         metavar="PASS",
         help=f"Password for Neo4j authentication (default: {neo4j_conf.get('neo4j-pass')})",
     )
+    neo4j.add_argument(
+        "--neo4j-pool-size",
+        default=neo4j_conf.get("neo4j-pool-size"),
+        metavar="SIZE",
+        help=f"Maximum number of connections in the driver pool (default: {neo4j_conf.get('neo4j-pool-size')})",
+        type=int,
+    )
+    neo4j.add_argument(
+        "--neo4j-fetch-size",
+        default=neo4j_conf.get("neo4j-fetch-size"),
+        metavar="SIZE",
+        help=f"Number of records fetched per batch (default: {neo4j_conf.get('neo4j-fetch-size')})",
+        type=int,
+    )
+    neo4j.add_argument(
+        "--neo4j-query-cache-size",
+        default=neo4j_conf.get("neo4j-query-cache-size"),
+        metavar="N",
+        help=f"Number of read query results kept in memory, 0 to disable (default: {neo4j_conf.get('neo4j-query-cache-size')})",
+        type=int,
+    )
+    neo4j.add_argument(
+        "--neo4j-batch-size",
+        default=neo4j_conf.get("neo4j-batch-size"),
+        metavar="ROWS",
+        help=f"Number of rows written per enrichment query (default: {neo4j_conf.get('neo4j-batch-size')})",
+        type=int,
+    )
+    neo4j.add_argument(
+        "--neo4j-write-concurrency",
+        default=neo4j_conf.get("neo4j-write-concurrency"),
+        metavar="N",
+        help=f"Number of sessions writing the enrichment concurrently (default: {neo4j_conf.get('neo4j-write-concurrency')})",
+        type=int,
+    )
+    neo4j.add_argument(
+        "--chunked-writes",
+        action="store_true",
+        help="Write the enrichment with one query per type committing every --neo4j-batch-size rows on the database side",
+    )
+    neo4j.add_argument(
+        "--profile-queries",
+        action="store_true",
+        help="Capture the PROFILE plan of each query shape and print a report of the queries at exit",
+    )
+
+    # Offline BloodHound data
+    offline = parser.add_argument_group("Offline BloodHound data")
+    offline.add_argument(
+        "--bloodhound-zip",
+        metavar="ZIP",
+        help="Load a BloodHound collector zip in memory instead of connecting to Neo4j (read-only)",
+    )
+
+    # Name resolution
+    resolution = parser.add_argument_group("Name resolution")
+    resolution.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the persistent cache of names resolved with BloodHound",
+    )
+    resolution.add_argument(
+        "--netbios-map",
+        metavar="FILE",
+        help="YAML file mapping NetBIOS names to domain names (e.g. NORTH: north.sevenkingdoms.local)",
+    )
+    resolution.add_argument(
+        "--non-interactive",
+        action="store_true",
+        help="Never prompt for unresolved NetBIOS names",
+    )
 
     # Commands
     subparsers = parser.add_subparsers(title="Commands", dest="command", required=True)
@@ -117,6 +189,34 @@ def main():
         action="store_true",
         help="Same as --enrich, but persists the groups relationships on BloodHound-CE (takes longer to run)",
     )
+    analysis_parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="With --enrich or --enrich-ce, remove the GPOHound relationships no longer justified by the GPOs",
+    )
+    analysis_parser.add_argument(
+        "--summary-edges",
+        action="store_true",
+        help="With --enrich or --enrich-ce, also write the effective access of the users and computers nested in the "
+        "enriched groups as derived relationships, used by the fast custom queries",
+    )
+    analysis_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted --enrich or --enrich-ce run from its last written batch",
+    )
+    analysis_parser.add_argument(
+        "--export",
+        metavar="DIR",
+        help="Write the enrichment to files in DIR for bulk import instead of Neo4j (works with --bloodhound-zip)",
+    )
+    analysis_parser.add_argument(
+        "--export-format",
+        metavar="",
+        help="Export formats : " + ", ".join(EnrichmentExporter.FORMATS) + " (default: all)",
+        choices=EnrichmentExporter.FORMATS,
+        nargs="+",
+    )
 
     analysis_output = analysis.add_argument_group(title="Output options")
     analysis_output.add_argument("--json", action="store_true", help="Format output as JSON")
@@ -159,6 +259,27 @@ def main():
         nargs="+",
     )
 
+    # Database command
+    database = subparsers.add_parser("db", help="Manage GPOHound data in the BloodHound database")
+    database.set_defaults(file=None, domain=None)
+    database_commands = database.add_subparsers(title="Database commands", dest="db_command", required=True)
+
+    db_prepare = database_commands.add_parser(
+        "prepare", help="Create the indexes and derived properties used by GPOHound lookups"
+    )
+    db_prepare.add_argument("--debug", action="store_true", help="Enable DEBUG output")
+
+    db_cleanup = database_commands.add_parser(
+        "cleanup", help="Remove the relationships, local groups and properties added by the enrichment"
+    )
+    db_cleanup.add_argument("--debug", action="store_true", help="Enable DEBUG output")
+
+    cleanup_filters = db_cleanup.add_argument_group(title="Filters")
+    cleanup_filters.add_argument("--domain", metavar="", help="Filter by one or more domains", nargs="+")
+    cleanup_filters.add_argument(
+        "--guid", metavar="", help="Only the computers affected by one or more GPO GUIDs", nargs="+"
+    )
+
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
@@ -181,6 +302,11 @@ def main():
         logging.error("'%s' does not exist.", args.sysvol_path)
         return
 
+    # Pruning compares the relationships in BloodHound with the analysis of all the GPOs
+    if getattr(args, "prune", False) and (args.guid or args.object or args.file):
+        logging.error("--prune can not be used with the --guid, --object or --file filters")
+        return
+
     # Set the list of files to parse
     if args.file:
         policy_files = [file_map[file] for file in args.file]
@@ -199,46 +325,69 @@ def main():
         args.neo4j_user,
         args.neo4j_pass,
         args.neo4j_port,
+        args.neo4j_pool_size,
+        args.neo4j_fetch_size,
+        args.neo4j_query_cache_size,
+        args.neo4j_batch_size,
+        args.chunked_writes,
+        args.neo4j_write_concurrency,
+        not args.no_cache,
+        args.non_interactive,
+        args.netbios_map,
+        args.bloodhound_zip,
+        args.profile_queries,
     )
 
-    if args.command == "dump":
-        gpohound_core.dump(
-            args.sysvol_path,
-            domains,
-            args.guid,
-            args.gpo_name,
-            args.json,
-            args.list,
-            args.search,
-            args.show,
-        )
+    try:
+        if args.command == "dump":
+            with gpohound_core.bloodhound_connector.read_transaction():
+                gpohound_core.dump(
+                    args.sysvol_path,
+                    domains,
+                    args.guid,
+                    args.gpo_name,
+                    args.json,
+                    args.list,
+                    args.search,
+                    args.show,
+                )
 
-    elif args.command == "analysis":
+        elif args.command == "analysis":
         
-        # Bloodhound Ingestor
-        if args.enrich_ce:
-            ingestor = "bh-ce"
-        elif args.enrich:
-            ingestor = "bh-legacy"
-        else:
-            ingestor = ""
+            # Bloodhound Ingestor
+            if args.enrich_ce:
+                ingestor = "bh-ce"
+            elif args.enrich:
+                ingestor = "bh-legacy"
+            else:
+                ingestor = ""
         
-        gpohound_core.analyser(
-            args.sysvol_path,
-            domains,
-            args.guid,
-            args.processed,
-            args.affected,
-            ingestor,
-            args.gpo_name,
-            args.order,
-            args.show,
-            args.object,
-            args.container,
-            args.computer,
-            args.user,
-            args.json,
-        )
-
-    if gpohound_core.bloodhound_connector.connection:
-        gpohound_core.bloodhound_connector.close()
+            gpohound_core.analyser(
+                args.sysvol_path,
+                domains,
+                args.guid,
+                args.processed,
+                args.affected,
+                ingestor,
+                args.gpo_name,
+                args.order,
+                args.show,
+                args.object,
+                args.container,
+                args.computer,
+                args.user,
+                args.json,
+                args.export,
+                args.export_format,
+                args.prune,
+                args.resume,
+                args.summary_edges,
+            )
+
+        elif args.command == "db":
+            if args.db_command == "prepare":
+                gpohound_core.prepare_database()
+            elif args.db_command == "cleanup":
+                gpohound_core.cleanup_database(domains, args.guid)
+    finally:
+        gpohound_core.close()
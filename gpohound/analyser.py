@@ -41,7 +41,7 @@ class GPOAnalyser:
                     output["Registry"] = registry_output
 
             if not objects or "privilege" in objects:
-                privilege_rights_output = self.privilege_rights_analyser.analyse(proccessed_gpo)
+                privilege_rights_output = self.privilege_rights_analyser.analyse(proccessed_gpo, domain_sid)
                 if privilege_rights_output:
                     output["Privilege Rights"] = privilege_rights_output
 
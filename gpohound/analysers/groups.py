@@ -29,6 +29,16 @@ class GroupAnalyser:
                     # Get container affected by the GPO
                     containers = self.ad_utils.get_containers_affected_by_gpo(gpo_guid, domain_sid) or []
 
+                    # Get the machines of the new containers in one batch, from the computers of the domain loaded once
+                    self.ad_utils.prefetch_machines_in_containers(
+                        [
+                            container.get("objectid")
+                            for container in containers
+                            if not container.get("objectid") in self.container_machines
+                        ],
+                        domain_sid,
+                    )
+
                     # Get machines names affected by the GPO
                     machines_names = []
                     for container in containers:
@@ -40,13 +50,16 @@ class GroupAnalyser:
 
                             for machine in container_machines:
                                 self.container_machines[container.get("objectid")].append(
-                                    machine.get("samaccountname", "")
+                                    machine.get("samaccountname") or ""
                                 )
 
                         machines_names.extend(self.container_machines[container.get("objectid")])
 
-                    # Check if the resolved name exists for each machine
+                    # Check if the resolved name exists for each machine with a sAMAccountName
                     for machine_name in machines_names:
+                        if not machine_name:
+                            continue
+
                         samaccountname = re.sub(
                             r"\%computername\%",
                             machine_name.strip("$"),
@@ -55,13 +68,13 @@ class GroupAnalyser:
                         )
 
                         if self.all_samaccountnames is None:
-                            self.all_samaccountnames = set()
+                            self.samaccountname_sid = {}
                             results = self.ad_utils.get_all_samaccountnames()
                             if results:
                                 self.samaccountname_sid = {
                                     object["samaccountname"].upper(): object["objectid"].upper() for object in results
                                 }
-                                self.all_samaccountnames = set(self.samaccountname_sid.keys())
+                            self.all_samaccountnames = set(self.samaccountname_sid.keys())
 
                         if not samaccountname.upper() in self.all_samaccountnames:
                             hijackable.add(samaccountname)
@@ -145,6 +158,11 @@ class GroupAnalyser:
                                             "sid": member.get("sid"),
                                             "name": member.get("name"),
                                         }
+
+                                        # Users and computers behind the member
+                                        effective = self.ad_utils.effective_counts(member.get("sid"), domain_sid)
+                                        if effective:
+                                            entry["effective"] = effective
                                         output[group_sid].setdefault("Members", []).append(entry)
 
                                         # Find System Defined Variables
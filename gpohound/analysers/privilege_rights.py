@@ -8,7 +8,7 @@ class PrivilegeRightsAnalyser:
         self.ad_utils = ad_utils
         self.privileged_groups = load_yaml_config(config, config_file)
 
-    def analyse(self, processed_gpo):
+    def analyse(self, processed_gpo, domain_sid=None):
         """
         Get trustees that can elevate their privilege using User Rights Assignment
         """
@@ -32,6 +32,11 @@ class PrivilegeRightsAnalyser:
                         ):
                             continue
 
+                        # Users and computers behind the trustee
+                        effective = self.ad_utils.effective_counts(sid, domain_sid)
+                        if effective:
+                            trustee = dict(trustee, effective=effective)
+
                         not_default.append(trustee)
 
                     if not_default:
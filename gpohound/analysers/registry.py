@@ -10,6 +10,62 @@ class RegistryAnalyser:
     def __init__(self, config="config.analysis", config_file="registry.yaml"):
         self.registry_config = load_yaml_config(config, config_file)
 
+        # Rules indexed by condition, compiled once
+        self.exact_rules = {}
+        self.suffix_trie = {}
+        self.regex_rules = []
+        self.regex_filter = None
+        self.compile_rules()
+
+    def compile_rules(self):
+        """
+        Index the rules by condition : exact keys in a map, suffixes in a trie of reversed keys
+        and regexes behind one alternation which only needs to match for the regexes to be tested
+        """
+
+        for idx, sensitive_registry in enumerate(self.registry_config):
+            key = str(sensitive_registry.get("key")).lower()
+
+            match sensitive_registry.get("condition"):
+
+                case "value_equals" | "value_less_than":
+                    self.exact_rules.setdefault(key, []).append((idx, sensitive_registry))
+
+                case "key_ends_with":
+                    node = self.suffix_trie
+                    for char in reversed(key):
+                        node = node.setdefault(char, {})
+                    node.setdefault(None, []).append((idx, sensitive_registry))
+
+                case "key_regex":
+                    self.regex_rules.append((idx, sensitive_registry, re.compile(key)))
+
+        if self.regex_rules:
+            try:
+                self.regex_filter = re.compile("|".join(f"(?:{pattern.pattern})" for _, _, pattern in self.regex_rules))
+            except re.error as error:
+                logging.debug("Registry regexes can't be combined, they are tested one by one : %s", error)
+
+    def match_rules(self, key):
+        """
+        Rules whose key condition matches a lowercased registry key, as (rule index, rule)
+        """
+
+        rules = list(self.exact_rules.get(key, []))
+
+        # Walk the trie from the end of the key, every rule met is a suffix
+        node = self.suffix_trie
+        for char in reversed(key):
+            node = node.get(char)
+            if node is None:
+                break
+            rules.extend(node.get(None, []))
+
+        if self.regex_rules and (self.regex_filter is None or self.regex_filter.search(key)):
+            rules.extend((idx, rule) for idx, rule, pattern in self.regex_rules if pattern.search(key))
+
+        return rules
+
     def analyse(self, processed_gpo):
         """
         Find interesting keys based on some conditions
@@ -21,40 +77,28 @@ class RegistryAnalyser:
 
             for config in ["Registry.xml", "registry.pol", "Registry Values"]:
 
-                # Iterates over sensitive registry keys
-                for sensitive_registry in self.registry_config:
+                # Matching rules of each key, ordered by rule then by key
+                matches = []
+                for registry_idx, registry in enumerate(processed_gpo.get(policy_type, {}).get(config, [])):
 
-                    for registry in processed_gpo.get(policy_type, {}).get(config, []):
+                    for rule_idx, sensitive_registry in self.match_rules(registry.get("Key").lower()):
 
-                        # Try to match sensitive registry condition with current key
+                        # Check the value condition
                         match sensitive_registry.get("condition"):
 
                             case "value_equals":
-                                if (
-                                    registry.get("Key").lower() == sensitive_registry.get("key").lower()
-                                    and str(registry.get("Data").lower())
-                                    == str(sensitive_registry.get("value")).lower()
-                                ):
-                                    entry = self.analysis_output(registry, sensitive_registry)
-                                    results.setdefault(policy_type, []).append(entry)
+                                if str(registry.get("Data").lower()) != str(sensitive_registry.get("value")).lower():
+                                    continue
 
                             case "value_less_than":
-                                if registry.get("Key").lower() == sensitive_registry.get("key").lower() and int(
-                                    registry.get("Data")
-                                ) < int(sensitive_registry.get("value")):
-                                    entry = self.analysis_output(registry, sensitive_registry)
-                                    results.setdefault(policy_type, []).append(entry)
-
-                            case "key_ends_with":
-                                if registry.get("Key").lower().endswith(sensitive_registry.get("key").lower()):
-                                    entry = self.analysis_output(registry, sensitive_registry)
-                                    results.setdefault(policy_type, []).append(entry)
-
-                            case "key_regex":
-                                pattern = re.compile(sensitive_registry.get("key").lower())
-                                if pattern.search(registry.get("Key").lower()):
-                                    entry = self.analysis_output(registry, sensitive_registry)
-                                    results.setdefault(policy_type, []).append(entry)
+                                if int(registry.get("Data")) >= int(sensitive_registry.get("value")):
+                                    continue
+
+                        matches.append((rule_idx, registry_idx, registry, sensitive_registry))
+
+                for _, _, registry, sensitive_registry in sorted(matches, key=lambda match: match[:2]):
+                    entry = self.analysis_output(registry, sensitive_registry)
+                    results.setdefault(policy_type, []).append(entry)
 
         return results
 
@@ -7,10 +7,14 @@ from gpohound.parser import GPOParser
 from gpohound.processor import GPOProcessor
 from gpohound.analyser import GPOAnalyser
 from gpohound.enricher import BloodHoundEnricher
+from gpohound.exporter import EnrichmentExporter
 
 from gpohound.utils.utils import search_keys_values, print_dict_as_tree, print_processed, print_analysed, print_enriched
+from gpohound.utils.utils import print_query_report
 from gpohound.utils.bloodhound import BloodHoundConnector
+from gpohound.utils.offline_bloodhound import OfflineBloodHoundConnector
 from gpohound.utils.ad import ActiveDirectoryUtils
+from gpohound.utils.cache import ResolutionCache, EnrichmentCheckpoint
 
 class GPOHoundCore:
     """
@@ -24,20 +28,159 @@ class GPOHoundCore:
         neo4j_user=None,
         neo4j_password=None,
         neo4j_port=None,
+        neo4j_pool_size=None,
+        neo4j_fetch_size=None,
+        neo4j_query_cache_size=None,
+        neo4j_batch_size=None,
+        neo4j_chunked_writes=False,
+        neo4j_write_concurrency=None,
+        use_cache=True,
+        non_interactive=False,
+        netbios_map=None,
+        bloodhound_zip=None,
+        profile_queries=False,
     ):
 
-        # BloodHound interactions
-        self.bloodhound_connector = BloodHoundConnector(neo4j_host, neo4j_user, neo4j_password, neo4j_port)
-        self.bloodhound_enricher = BloodHoundEnricher(self.bloodhound_connector)
+        # BloodHound interactions, from a collector zip loaded in memory or from Neo4j
+        if bloodhound_zip:
+            self.bloodhound_connector = OfflineBloodHoundConnector(bloodhound_zip)
+        else:
+            self.bloodhound_connector = BloodHoundConnector(
+                neo4j_host,
+                neo4j_user,
+                neo4j_password,
+                neo4j_port,
+                neo4j_pool_size,
+                neo4j_fetch_size,
+                neo4j_query_cache_size,
+                neo4j_batch_size,
+                neo4j_chunked_writes,
+                neo4j_write_concurrency,
+                profile_queries,
+            )
+
+        # Persistent name resolution cache, scoped to the imported BloodHound collection
+        self.resolution_cache = None
+        if use_cache and self.bloodhound_connector.connection and not self.bloodhound_connector.offline:
+            fingerprint = ResolutionCache.compute_fingerprint(self.bloodhound_connector.fingerprint())
+            self.resolution_cache = ResolutionCache(fingerprint)
 
         # Active Directory utilities
-        self.ad_utils = ActiveDirectoryUtils(self.bloodhound_connector)
+        self.ad_utils = ActiveDirectoryUtils(
+            self.bloodhound_connector,
+            cache=self.resolution_cache,
+            non_interactive=non_interactive,
+        )
+
+        self.bloodhound_enricher = BloodHoundEnricher(self.bloodhound_connector, self.ad_utils)
+        self.enrichment_exporter = EnrichmentExporter(self.bloodhound_enricher)
+
+        # Resolve NetBIOS names up front instead of prompting during processing
+        if self.bloodhound_connector.connection:
+            self.ad_utils.load_netbios_names(netbios_map)
 
         # GPO parser, processor and analyser
         self.gpo_parser = GPOParser(policy_files)
         self.gpo_processor = GPOProcessor(self.ad_utils)
         self.gpo_analyser = GPOAnalyser(self.ad_utils)
 
+    def close(self):
+        """
+        Persist the resolution cache, close the enrichment checkpoints and the BloodHound connection
+        """
+        if self.resolution_cache:
+            self.resolution_cache.close()
+
+        if getattr(self.bloodhound_connector, "checkpoint", None):
+            self.bloodhound_connector.checkpoint.close()
+
+        if self.bloodhound_connector.connection:
+            self.bloodhound_connector.close()
+
+        # Query statistics, with the PROFILE plans with "--profile-queries"
+        query_stats = self.bloodhound_connector.query_stats
+        if query_stats:
+            query_stats.log_summary()
+            self.bloodhound_connector.query_memo.log_summary()
+            if query_stats.profile:
+                print_query_report(query_stats)
+
+    def prepare_database(self):
+        """
+        Create the indexes and derived properties used by GPOHound lookups
+        """
+
+        if not self.bloodhound_connector.connection:
+            logging.info("This command requires a working bloodhound connection")
+            sys.exit()
+
+        if self.bloodhound_connector.offline:
+            logging.info("This command requires a Neo4j database, BloodHound zip files are loaded read-only")
+            sys.exit()
+
+        prepared = self.bloodhound_connector.prepare()
+        logging.info(
+            "Indexes created, derived properties set on %s GPOs and %s accounts",
+            prepared.get("gpos", 0),
+            prepared.get("accounts", 0),
+        )
+
+    def cleanup_database(self, domains=None, guids=None):
+        """
+        Remove the relationships, local groups and properties added by the enrichment, in batches.
+        With GUIDs, only the computers affected by these GPOs are cleaned up.
+        """
+
+        if not self.bloodhound_connector.connection:
+            logging.info("This command requires a working bloodhound connection")
+            sys.exit()
+
+        if self.bloodhound_connector.offline:
+            logging.info("This command requires a Neo4j database, BloodHound zip files are loaded read-only")
+            sys.exit()
+
+        # Domains to clean up, all of them by default
+        if domains:
+            domain_sids = {domain: self.ad_utils.domain_to_sid(domain) for domain in domains}
+        elif guids:
+            domain_sids = {domain.get("domain"): domain.get("objectid") for domain in self.ad_utils.get_domains() or []}
+        else:
+            domain_sids = {None: None}
+
+        removed = {"relationships": 0, "memberships": 0, "groups": 0, "computers": 0}
+        for domain, domain_sid in domain_sids.items():
+            if domain and not domain_sid:
+                logging.info("Domain %s not found in BloodHound", domain)
+                continue
+
+            # Computers affected by the GPOs
+            computers = None
+            if guids:
+                computers = set()
+                for guid in guids:
+                    for container in self.ad_utils.get_containers_affected_by_gpo(guid, domain_sid) or []:
+                        machines = self.ad_utils.get_machines_in_container(container.get("objectid"), domain_sid)
+                        computers.update(machine["objectid"] for machine in machines or [])
+                if not computers:
+                    continue
+                computers = sorted(computers)
+
+            removed["relationships"] += self.bloodhound_connector.cleanup_edges(domain_sid, computers)
+            memberships, groups = self.bloodhound_connector.cleanup_local_groups(domain_sid, computers)
+            removed["memberships"] += memberships
+            removed["groups"] += groups
+            removed["computers"] += self.bloodhound_connector.cleanup_properties(
+                self.bloodhound_enricher.property_keys(), domain_sid, computers
+            )
+
+        logging.info(
+            "Removed %s relationships, %s local group memberships, %s local groups and the properties of %s computers",
+            removed["relationships"],
+            removed["memberships"],
+            removed["groups"],
+            removed["computers"],
+        )
+
     def dump(
         self,
         sysvol_path,
@@ -143,6 +286,11 @@ class GPOHoundCore:
         computer=None,
         user=None,
         print_json=False,
+        export_dir=None,
+        export_formats=None,
+        prune=False,
+        resume=False,
+        summary_edges=False,
     ):
         """
         Process the GPO and groups settings types
@@ -150,23 +298,46 @@ class GPOHoundCore:
         Enrich bloodhooud with found vulnerabilites
         """
 
+        # The enrichment is written to Neo4j by the ingestor or to files by the exporter
+        enrichment = ingestor or export_dir
+
         if not self.ad_utils.bloodhound.connection and (
-            affected or order or ingestor or container or user or computer or gpo_name or show
+            affected or order or enrichment or container or user or computer or gpo_name or show
         ):
             logging.info("This command requires a working bloodhound connection")
             sys.exit()
 
-        if not self.ad_utils.bloodhound.apoc and ingestor:
-            logging.info(
-                "This command requires to have APOC installed for Neo4j. Check the GPOHound documentation for more information"
-            )
+        if self.ad_utils.bloodhound.offline and ingestor and not export_dir:
+            logging.info("The ingestor requires a Neo4j database, BloodHound zip files are loaded read-only")
+            sys.exit()
+
+        if resume and (not ingestor or export_dir):
+            logging.info("--resume continues an interrupted --enrich or --enrich-ce run")
             sys.exit()
 
+        # Enrichment plans, written domains and batches, a run without --resume starts over
+        pending_domains = []
+        done_domains = []
+        if ingestor and not export_dir:
+            fingerprint = ResolutionCache.compute_fingerprint(self.bloodhound_connector.fingerprint())
+            self.bloodhound_connector.checkpoint = EnrichmentCheckpoint(fingerprint)
+            if resume:
+                pending_domains = self.bloodhound_connector.checkpoint.pending_domains()
+                done_domains = self.bloodhound_connector.checkpoint.done_domains()
+                if not pending_domains and not done_domains:
+                    logging.info("No interrupted enrichment to resume, the enrichment is run entirely")
+            else:
+                self.bloodhound_connector.checkpoint.clear()
+
         if order and not (container or computer or user):
             logging.info("You need to specify a target...")
             sys.exit()
 
-        self.gpo_parser.parse_domain_policies(sysvol_path)
+        # The GPOs of the domains written by the interrupted enrichment are not parsed again
+        if container or computer or user:
+            self.gpo_parser.parse_domain_policies(sysvol_path)
+        else:
+            self.gpo_parser.parse_domain_policies(sysvol_path, pending_domains + done_domains)
 
         if not self.gpo_parser.policies:
             logging.info("No GPOs were found...")
@@ -184,141 +355,173 @@ class GPOHoundCore:
 
         if container or computer or user:
 
-            if container:
-                found_container = self.ad_utils.find_container(container)
-            elif computer:
-                found_container = self.ad_utils.find_trustee_container(computer)
-            else:
-                found_container = self.ad_utils.find_trustee_container(user)
-
-            if found_container:
-                container_id = found_container.get("objectid")
-                container_dn = found_container.get("distinguishedname")
-                domain_sid = found_container.get("domainsid")
-                domain = self.ad_utils.find_by_sid(domain_sid).get("name", "").lower()
-                ordered_gpos = self.ad_utils.container_inheritance(container_id)
-
-                if show:
-                    gpo_inheritance = {}
-                    for idx, gpo in enumerate(ordered_gpos, start=1):
-                        if "name" in gpo:
-                            gpo_guid = "{" + gpo["gpcpath"].split("{", 1)[1].split("}")[0] + "}"
-                            if gpo_guid in self.gpo_parser.policies[domain]:
-                                gpo_name = gpo["name"]
-                                title = f"{idx} - {gpo_guid}: {gpo_name}"
-                                data = self.gpo_parser.policies[domain][gpo_guid]
-                                if data:
-                                    if container:
-                                        gpo_inheritance[title] = data
-                                    elif computer and data.get("Machine"):
-                                        gpo_inheritance[title] = data.get("Machine")
-                                    elif user and data.get("User"):
-                                        gpo_inheritance[title] = data.get("User")
+            # Read and resolve in one transaction, this command does not write
+            with self.bloodhound_connector.read_transaction():
+                if container:
+                    found_container = self.ad_utils.find_container(container)
+                elif computer:
+                    found_container = self.ad_utils.find_trustee_container(computer)
+                else:
+                    found_container = self.ad_utils.find_trustee_container(user)
+
+                if found_container:
+                    container_id = found_container.get("objectid")
+                    container_dn = found_container.get("distinguishedname")
+                    domain_sid = found_container.get("domainsid")
+                    domain = (self.ad_utils.sid_to_domain(domain_sid) or "").lower()
+                    ordered_gpos = self.ad_utils.container_inheritance(container_id, domain_sid)
+
+                    if show:
+                        gpo_inheritance = {}
+                        for idx, gpo in enumerate(ordered_gpos, start=1):
+                            if gpo.get("name"):
+                                gpo_guid = "{" + gpo["gpcpath"].split("{", 1)[1].split("}")[0] + "}"
+                                if gpo_guid in self.gpo_parser.policies[domain]:
+                                    gpo_name = gpo["name"]
+                                    title = f"{idx} - {gpo_guid}: {gpo_name}"
+                                    data = self.gpo_parser.policies[domain][gpo_guid]
+                                    if data:
+                                        if container:
+                                            gpo_inheritance[title] = data
+                                        elif computer and data.get("Machine"):
+                                            gpo_inheritance[title] = data.get("Machine")
+                                        elif user and data.get("User"):
+                                            gpo_inheritance[title] = data.get("User")
+                                else:
+                                    title = f"{idx} - Empty GPO"
+                                    gpo_inheritance[title] = None
                             else:
-                                title = f"{idx} - Empty GPO"
+                                title = f"{idx} - Unknown GPO"
                                 gpo_inheritance[title] = None
-                        else:
-                            title = f"{idx} - Unknown GPO"
-                            gpo_inheritance[title] = None
-                    output_show.update({container_dn: gpo_inheritance})
-
-                elif order:
-                    gpo_inheritance = []
-                    for idx, gpo in enumerate(ordered_gpos, start=1):
-                        if "name" in gpo:
-                            gpo_guid = "{" + gpo["gpcpath"].split("{", 1)[1].split("}")[0] + "}"
-                            gpo_name = gpo["name"]
-                            gpo_inheritance.append(f"{idx} - {gpo_guid}: {gpo_name}")
-                        else:
-                            gpo_inheritance.append(f"{idx} - Unknown GPO")
-                    output_order.update({container_dn: gpo_inheritance})
-
-                elif domain and domain_sid and domain in self.gpo_parser.policies:
-                    gpo_settings = {}
-                    for gpo in ordered_gpos:
-                        if "name" in gpo:
-                            gpo_guid = "{" + gpo["gpcpath"].split("{", 1)[1].split("}")[0] + "}"
-                            if gpo_guid in self.gpo_parser.policies[domain]:
-                                gpo_name = gpo["name"]
-                                gpo_settings = self.gpo_parser.policies[domain][gpo_guid]
-                                if gpo_settings:
-
-                                    proccessed_gpo = self.gpo_processor.process(gpo_settings, objects, domain_sid)
-
-                                    if proccessed_gpo and processed:
-                                        output_proccessed.setdefault(domain, {}).setdefault(gpo_guid, {}).update(
-                                            proccessed_gpo
-                                        )
+                        output_show.update({container_dn: gpo_inheritance})
 
-                                    elif proccessed_gpo:
-                                        analysis = self.gpo_analyser.analyse(
-                                            domain_sid, gpo_guid, gpo_settings, proccessed_gpo, objects
-                                        )
+                    elif order:
+                        gpo_inheritance = []
+                        for idx, gpo in enumerate(ordered_gpos, start=1):
+                            if gpo.get("name"):
+                                gpo_guid = "{" + gpo["gpcpath"].split("{", 1)[1].split("}")[0] + "}"
+                                gpo_name = gpo["name"]
+                                gpo_inheritance.append(f"{idx} - {gpo_guid}: {gpo_name}")
+                            else:
+                                gpo_inheritance.append(f"{idx} - Unknown GPO")
+                        output_order.update({container_dn: gpo_inheritance})
+
+                    elif domain and domain_sid and domain in self.gpo_parser.policies:
+                        gpo_settings = {}
+                        for gpo in ordered_gpos:
+                            if gpo.get("name"):
+                                gpo_guid = "{" + gpo["gpcpath"].split("{", 1)[1].split("}")[0] + "}"
+                                if gpo_guid in self.gpo_parser.policies[domain]:
+                                    gpo_name = gpo["name"]
+                                    gpo_settings = self.gpo_parser.policies[domain][gpo_guid]
+                                    if gpo_settings:
+
+                                        proccessed_gpo = self.gpo_processor.process(gpo_settings, objects, domain_sid)
+
+                                        if proccessed_gpo and processed:
+                                            output_proccessed.setdefault(domain, {}).setdefault(gpo_guid, {}).update(
+                                                proccessed_gpo
+                                            )
 
-                                        if analysis:
-                                            output_analysis.setdefault(domain, {}).setdefault(gpo_guid, {}).update(
-                                                analysis
+                                        elif proccessed_gpo:
+                                            analysis = self.gpo_analyser.analyse(
+                                                domain_sid, gpo_guid, gpo_settings, proccessed_gpo, objects
                                             )
 
+                                            if analysis:
+                                                output_analysis.setdefault(domain, {}).setdefault(gpo_guid, {}).update(
+                                                    analysis
+                                                )
+
         else:
             # Iterates over domains
             for domain, gpos in self.gpo_parser.policies.items():
 
                 analyses = {}
+                analysed_gpos = {}
 
                 domain_sid = self.ad_utils.domain_to_sid(domain)
                 if domains and domain not in domains:
                     continue
 
-                # Iterates over GPOs
-                for gpo_guid, gpo_settings in gpos.items():
-                    if guids and gpo_guid not in guids:
-                        continue
+                # Write the remaining batches of an interrupted enrichment, without analysing the GPOs again
+                if domain in pending_domains:
+                    output_enrichment[domain] = self.bloodhound_enricher.resume(domain)
+                    continue
 
-                    # Process the GPOs
-                    proccessed_gpo = self.gpo_processor.process(gpo_settings, objects, domain_sid)
+                # Domains entirely written before the interruption
+                if domain in done_domains:
+                    output_enrichment[domain] = self.bloodhound_enricher.completed(domain)
+                    continue
 
-                    # Proccessed settings output
-                    if proccessed_gpo and processed:
-                        output_proccessed.setdefault(domain, {}).setdefault(gpo_guid, {}).update(proccessed_gpo)
+                # Read and resolve in one transaction, closed before the enrichment writes
+                with self.bloodhound_connector.read_transaction():
+                    # Iterates over GPOs
+                    for gpo_guid, gpo_settings in gpos.items():
+                        if guids and gpo_guid not in guids:
+                            continue
 
-                    # Analyse the GPOs settings
-                    else:
-                        analysis = self.gpo_analyser.analyse(
-                            domain_sid, gpo_guid, gpo_settings, proccessed_gpo, objects
-                        )
-
-                        if analysis:
-
-                            # Get container list affected by the GPO
-                            if (affected or ingestor) and domain_sid:
-                                found_containers = self.ad_utils.get_containers_affected_by_gpo(gpo_guid, domain_sid)
-
-                                if found_containers:    
-                                    # Get analysis data and affected containers for enrichement
-                                    if ingestor:
-                                        analyses[gpo_guid] = {
-                                            "analysis": analysis,
-                                            "affected": [container.get("objectid") for container in found_containers],
-                                        }
-
-                                    # Add container list to processed GPO and vulnerability outputs
-                                    if affected:
-                                        containers_dn = [
-                                            container.get("distinguishedname") for container in found_containers
-                                        ]
-                                        output_analysis.setdefault(domain, {}).setdefault(gpo_guid, {}).setdefault(
-                                            "Affected Containers", []
-                                        ).extend(containers_dn)
-                                        output_analysis.setdefault(domain, {}).setdefault(gpo_guid, {}).update(analysis)
+                        # Process the GPOs
+                        proccessed_gpo = self.gpo_processor.process(gpo_settings, objects, domain_sid)
 
-                            else:
-                                # Analysis output to print
-                                output_analysis.setdefault(domain, {}).setdefault(gpo_guid, {}).update(analysis)
+                        # Proccessed settings output
+                        if proccessed_gpo and processed:
+                            output_proccessed.setdefault(domain, {}).setdefault(gpo_guid, {}).update(proccessed_gpo)
 
-                # Enrich bloodhound with found vulnerabilities
-                if ingestor and domain_sid and analyses:
-                    output_enrichment[domain] = self.bloodhound_enricher.enrich(analyses, domain, domain_sid, ingestor)
+                        # Analyse the GPOs settings
+                        else:
+                            analysis = self.gpo_analyser.analyse(
+                                domain_sid, gpo_guid, gpo_settings, proccessed_gpo, objects
+                            )
+
+                            if analysis:
+                                analysed_gpos[gpo_guid] = analysis
+
+                    # Compute the containers affected by all the analysed GPOs of the domain in one pass
+                    if (affected or enrichment) and domain_sid:
+                        self.ad_utils.prefetch_affected_containers(list(analysed_gpos.keys()), domain_sid)
+
+                    for gpo_guid, analysis in analysed_gpos.items():
+
+                        # Get container list affected by the GPO
+                        if (affected or enrichment) and domain_sid:
+                            found_containers = self.ad_utils.get_containers_affected_by_gpo(gpo_guid, domain_sid)
+
+                            if found_containers:
+                                # Get analysis data and affected containers for enrichement
+                                if enrichment:
+                                    analyses[gpo_guid] = {
+                                        "analysis": analysis,
+                                        "affected": [container.get("objectid") for container in found_containers],
+                                    }
+
+                                # Add container list to processed GPO and vulnerability outputs
+                                if affected:
+                                    containers_dn = [
+                                        container.get("distinguishedname") for container in found_containers
+                                    ]
+                                    output_analysis.setdefault(domain, {}).setdefault(gpo_guid, {}).setdefault(
+                                        "Affected Containers", []
+                                    ).extend(containers_dn)
+                                    output_analysis.setdefault(domain, {}).setdefault(gpo_guid, {}).update(analysis)
+
+                        else:
+                            # Analysis output to print
+                            output_analysis.setdefault(domain, {}).setdefault(gpo_guid, {}).update(analysis)
+
+                # Export the enrichment to files for bulk import
+                if export_dir and domain_sid and analyses:
+                    output_enrichment[domain] = self.enrichment_exporter.export(
+                        analyses, domain, domain_sid, export_dir, export_formats
+                    )
+
+                # Enrich bloodhound with found vulnerabilities, with prune even without findings left
+                elif ingestor and not export_dir and domain_sid and (analyses or prune):
+                    enriched = self.bloodhound_enricher.enrich(
+                        analyses, domain, domain_sid, ingestor, prune, summary_edges
+                    )
+                    if analyses:
+                        output_enrichment[domain] = enriched
 
         # Print processed settings
         if processed:
@@ -334,7 +537,7 @@ class GPOHoundCore:
                 print_processed(output_proccessed)
 
         # Print enrichement output
-        elif ingestor:
+        elif enrichment:
             if not output_enrichment:
                 logging.info("No GPOs found to enrich BloodHound data...")
                 sys.exit()
@@ -1,27 +1,107 @@
 import logging
 from rich.progress import track
 
+from gpohound.utils.utils import load_yaml_config
+
 class BloodHoundEnricher:
     """
     Enrich BloodHound data
     """
 
-    def __init__(self, bloodhound_connector):
+    def __init__(self, bloodhound_connector, ad_utils):
         self.bloodhound = bloodhound_connector
+        self.ad_utils = ad_utils
+        self.trustee_types = {}
+        self.computer_names = {}
+
+    @staticmethod
+    def property_keys():
+        """
+        Keys of the properties the enrichment can add to computers
+        """
+        keys = set()
+        for registry in load_yaml_config("config.analysis", "registry.yaml"):
+            bloodhound_property = registry.get("bloodhound_property")
+            if isinstance(bloodhound_property, dict):
+                keys.update(bloodhound_property)
+            elif bloodhound_property:
+                keys.add(bloodhound_property)
+        return sorted(keys)
+
+    def resolve_trustees(self, analyses, domain_sid):
+        """
+        Get the objectids and sAMAccountNames of all the trustees found in the analyses with one query
+        """
+
+        trustees_sid = set()
+        for data in analyses.values():
+            analysed_gpo = data["analysis"]
+
+            for analysed_settings in analysed_gpo.get("Memberships", {}).values():
+                for group in analysed_settings:
+                    for member in group.get("Members", []):
+                        if member.get("sid"):
+                            trustees_sid.add(member["sid"].upper())
+                    for entry in group.get("EnvMembers", []):
+                        if entry.get("sid"):
+                            trustees_sid.add(entry["sid"].upper())
+
+            for analysed_settings in analysed_gpo.get("Privilege Rights", {}).values():
+                for entry in analysed_settings.values():
+                    for trustee in entry["trustees"]:
+                        if trustee.get("sid"):
+                            trustees_sid.add(trustee["sid"].upper())
+
+        if not trustees_sid:
+            return {}
+
+        found = {}
+        for trustee in self.bloodhound.find_trustees(domain_sid, trustees_sid):
+            found[trustee["objectid"]] = trustee["samaccountname"]
+            self.trustee_types[trustee["objectid"]] = trustee.get("type")
+
+        # SID -> [(objectid, samaccountname)], well-known SIDs can match a prefixed objectid
+        trustees = {}
+        for sid in trustees_sid:
+            objectids = self.bloodhound.trustee_objectids([sid])
+            trustees[sid] = [(objectid, found[objectid]) for objectid in objectids if objectid in found]
+        return trustees
+
+    def get_computers(self, container_ids, domain_sid):
+        """
+        Get the objectids and sAMAccountNames of the computers in the containers
+        """
+
+        self.ad_utils.prefetch_machines_in_containers(container_ids, domain_sid)
 
-    def enrich(self, analyses, domain, domain_sid, ingestor):
+        computers = {}
+        for container_id in container_ids:
+            for machine in self.ad_utils.get_machines_in_container(container_id, domain_sid) or []:
+                computers[machine["objectid"]] = machine.get("samaccountname")
+                if machine.get("name"):
+                    self.computer_names[machine["objectid"]] = machine["name"]
+        return computers
+
+    def plan(self, analyses, domain, domain_sid, ingestor):
         """
-        Apply found vulnerabilies to containers trustees
+        Collect and deduplicate the relationships, CE local group memberships and properties of all the GPOs of a domain
         """
 
         output_enrichment = {"Memberships": {}, "Privilege Rights": {}, "Properties": {}}
-        
+
+        # Enrichment plan
+        edges = set()
+        local_groups = set()
+        properties = {}
+
+        trustees = self.resolve_trustees(analyses, domain_sid)
+
         # Iterates over GPOs
         for data in track(analyses.values(), description=f"Enriching BloodHound with GPOs from {domain}", transient=True,):
             analysed_gpo = data["analysis"]
-            container_ids = data["affected"]
+            computers = self.get_computers(data["affected"], domain_sid)
 
-            # Applies local group memberships to computers
+            # Applies local group memberships to computers
             if "Memberships" in analysed_gpo:
 
                 for analysed_settings in analysed_gpo["Memberships"].values():
@@ -34,67 +114,40 @@ class BloodHoundEnricher:
 
                         if group_sid and edge:
 
-                            if "Members" in group:
-
-                                trustees_sid = []
-                                for member in group["Members"]:
-                                    sid = member.get("sid")
-                                    if sid:
-                                        trustees_sid.append(sid.upper())
-
-                                # Try to add new relationship between the members of the groups and the machines in the containers
-                                outputs = self.bloodhound.add_edges(domain_sid, container_ids, trustees_sid, edge)
+                            # Relationships between the members of the groups and the machines in the containers
+                            for member in group.get("Members", []):
+                                for trustee_id, trustee_name in trustees.get((member.get("sid") or "").upper(), []):
+                                    for computer_id, computer_name in computers.items():
+                                        edges.add((trustee_id, computer_id, edge))
+                                        if ingestor == "bh-ce":
+                                            local_groups.add((trustee_id, computer_id, group_sid, group_name))
 
-                                if outputs:
-                                    if ingestor == "bh-ce":
-                                        try:
-                                            self.bloodhound.add_edges_bhce(
-                                                domain_sid, container_ids, trustees_sid, group_sid, group_name
-                                            )
-                                        except Exception as e:
-                                            logging.debug("Error adding edges persistently for BloodHound CE: %s", e)
-
-                                    if not isinstance(outputs, list):
-                                        outputs = [outputs]
-
-                                    for output in outputs:
-                                        computer_name = output["c"]["samaccountname"]
-                                        trustee_name = output["t"]["samaccountname"]
                                         output_enrichment["Memberships"].setdefault(group_name, {}).setdefault(
                                             trustee_name, set()
                                         ).add(computer_name)
 
-                            if "EnvMembers" in group:
-                                for entry in group["EnvMembers"]:
-                                    if not entry["computer_name"] in output_enrichment["Memberships"].get(
-                                        group_name, {}
-                                    ).get(entry["name"], set()):
-                                        output = self.bloodhound.add_edge(
-                                            domain_sid, entry["sid"], entry["computer_sid"], edge
+                            # Relationships between the resolved members and their computer
+                            for entry in group.get("EnvMembers", []):
+                                if not entry.get("computer_sid"):
+                                    continue
+
+                                if entry.get("computer_name"):
+                                    self.computer_names.setdefault(
+                                        entry["computer_sid"].upper(), entry["computer_name"].rstrip("$").upper()
+                                    )
+
+                                for trustee_id, trustee_name in trustees.get((entry.get("sid") or "").upper(), []):
+                                    edges.add((trustee_id, entry["computer_sid"].upper(), edge))
+                                    if ingestor == "bh-ce":
+                                        local_groups.add(
+                                            (trustee_id, entry["computer_sid"].upper(), group_sid, group_name)
                                         )
 
-                                        if output:
-                                            if ingestor == "bh-ce":
-                                                try:
-                                                    self.bloodhound.add_edge_bhce(
-                                                        domain_sid,
-                                                        entry["sid"],
-                                                        entry["computer_sid"],
-                                                        group_sid,
-                                                        group_name,
-                                                    )
-                                                except Exception as e:
-                                                    logging.debug(
-                                                        "Error adding edges persistently for BloodHound CE: %s", e
-                                                    )
-
-                                            computer_name = output["c"]["samaccountname"]
-                                            trustee_name = output["t"]["samaccountname"]
-                                            output_enrichment["Memberships"].setdefault(group_name, {}).setdefault(
-                                                trustee_name, set()
-                                            ).add(computer_name)
-
-            # Adds interesting properties to computers
+                                    output_enrichment["Memberships"].setdefault(group_name, {}).setdefault(
+                                        trustee_name, set()
+                                    ).add(entry["computer_name"])
+
+            # Adds interesting properties to computers
             if "Registry" in analysed_gpo:
                 for analysed_settings in analysed_gpo["Registry"].values():
 
@@ -103,47 +156,284 @@ class BloodHoundEnricher:
 
                         if bloodhound_property:
 
-                            # Try to add new property to the machines in the containers
+                            # New property on the machines in the containers, the last GPO setting it wins
                             ((key, value),) = bloodhound_property.items()
-                            outputs = self.bloodhound.add_extra_property(container_ids, key, value)
+                            for computer_id, computer_name in computers.items():
+                                properties[(computer_id, key)] = value
+                                output_enrichment.setdefault("Properties", {}).setdefault((key, value), set()).add(
+                                    computer_name
+                                )
 
-                            if outputs:
-                                if not isinstance(outputs, list):
-                                    outputs = [outputs]
-
-                                for output in outputs:
-                                    computer_name = output["n"]["samaccountname"]
-                                    output_enrichment.setdefault("Properties", {}).setdefault((key, value), set()).add(
-                                        computer_name
-                                    )
-
-            # Adds relationships to computers where trustees can escalate priviliges
+            # Adds relationships to computers where trustees can escalate priviliges
             if "Privilege Rights" in analysed_gpo:
                 for analysed_settings in analysed_gpo["Privilege Rights"].values():
 
                     for privilege, entry in analysed_settings.items():
                         edge = entry.get("edge")
+                        if not edge:
+                            continue
 
-                        trustees_sid = []
+                        # Relationships between the privileged trustees and the machines in the container
                         for trustee in entry["trustees"]:
-                            sid = trustee.get("sid")
-                            if sid:
-                                trustees_sid.append(sid.upper())
+                            for trustee_id, trustee_name in trustees.get((trustee.get("sid") or "").upper(), []):
+                                for computer_id, computer_name in computers.items():
+                                    edges.add((trustee_id, computer_id, edge))
+                                    output_enrichment["Privilege Rights"].setdefault(privilege, {}).setdefault(
+                                        trustee_name, set()
+                                    ).add(computer_name)
 
-                        if trustees_sid:
+        return {
+            "edges": edges,
+            "local_groups": local_groups,
+            "properties": properties,
+            "computer_names": self.computer_names,
+            "output": output_enrichment,
+        }
 
-                            # Try to add new relationship between the privileged trustee and the machines in the container
-                            outputs = self.bloodhound.add_edges(domain_sid, container_ids, trustees_sid, edge)
+    def edge_rows(self, plan):
+        """
+        Relationships of a plan : {trustee, computer, edge}
+        """
+        return [
+            {"trustee": trustee, "computer": computer, "edge": edge}
+            for trustee, computer, edge in sorted(plan["edges"])
+        ]
 
-                            if not isinstance(outputs, list):
-                                outputs = [outputs]
+    def local_group_id(self, computer, group_sid):
+        """
+        Objectid of the local group of a computer : COMPUTER_SID-GROUP_RID
+        """
+        return f"{computer}-{group_sid.split('-')[-1]}".upper()
 
-                            for output in outputs:
-                                for output in outputs:
-                                    computer_name = output["c"]["samaccountname"]
-                                    trustee_name = output["t"]["samaccountname"]
-                                    output_enrichment["Privilege Rights"].setdefault(privilege, {}).setdefault(
-                                        trustee_name, set()
-                                    ).add(computer_name)
+    def local_group_rows(self, plan):
+        """
+        CE local group memberships of a plan : {trustee, computer, group_id, name}
+        """
+        return [
+            {
+                "trustee": trustee,
+                "computer": computer,
+                "group_id": self.local_group_id(computer, group_sid),
+                "name": f"{group_name or ''}@{plan['computer_names'].get(computer) or computer}".upper(),
+            }
+            for trustee, computer, group_sid, group_name in sorted(plan["local_groups"], key=lambda group: group[:3])
+        ]
+
+    def property_rows(self, plan):
+        """
+        Computer properties of a plan : {computer, key, value}
+        """
+        return [
+            {"computer": computer, "key": key, "value": value}
+            for (computer, key), value in plan["properties"].items()
+        ]
+
+    def delta(self, plan, domain_sid, local_groups=False):
+        """
+        Remove from a plan what is already in BloodHound.
+        Returns the relationships previously added by GPOHound which are no longer in the plan,
+        and with local groups, the local group memberships previously added which are no longer in the plan.
+        """
+
+        existing_edges = {
+            (row["trustee"], row["computer"], row["edge"]) for row in self.bloodhound.get_enrichment_edges(domain_sid)
+        }
+        stale_edges = existing_edges - plan["edges"]
+        plan["edges"] = plan["edges"] - existing_edges
+
+        stale_members = set()
+        if local_groups or plan["local_groups"]:
+            existing_members = set()
+            added_members = set()
+            for row in self.bloodhound.get_local_group_members(domain_sid):
+                member = (row["trustee"], row["computer"], row["group_id"])
+                existing_members.add(member)
+                if row.get("gpohound"):
+                    added_members.add(member)
+
+            planned_members = {
+                (trustee, computer, self.local_group_id(computer, group_sid))
+                for trustee, computer, group_sid, _ in plan["local_groups"]
+            }
+            stale_members = added_members - planned_members
+
+            plan["local_groups"] = {
+                (trustee, computer, group_sid, group_name)
+                for trustee, computer, group_sid, group_name in plan["local_groups"]
+                if (trustee, computer, self.local_group_id(computer, group_sid)) not in existing_members
+            }
+
+        if plan["properties"]:
+            keys = {key for _, key in plan["properties"]}
+            for row in self.bloodhound.get_computer_properties(domain_sid, keys):
+                if plan["properties"].get((row["computer"], row["key"])) == row["value"]:
+                    del plan["properties"][(row["computer"], row["key"])]
+
+        return stale_edges, stale_members
+
+    def derive(self, edges, domain_sid):
+        """
+        Effective access relationships from the users and computers nested in the groups of the relationships.
+        Returns the derived relationships missing from BloodHound and the ones which are no longer justified.
+        """
+
+        closure = self.ad_utils.get_membership_closure(domain_sid)
+
+        derived = set()
+        for trustee, computer, edge in edges:
+            for member in closure.effective_members(trustee):
+                if member != computer:
+                    derived.add((member, computer, edge))
+        derived -= edges
+
+        existing = {
+            (row["trustee"], row["computer"], row["edge"]) for row in self.bloodhound.get_derived_edges(domain_sid)
+        }
+        return self.edge_rows({"edges": derived - existing}), self.edge_rows({"edges": existing - derived})
+
+    def enrich(self, analyses, domain, domain_sid, ingestor, prune=False, summary_edges=False):
+        """
+        Apply found vulnerabilies to containers trustees.
+        The relationships and properties of all the GPOs are collected and deduplicated first,
+        only the ones missing from BloodHound are written in batches.
+        With prune, the relationships added by GPOHound which are no longer justified are removed.
+        With summary edges, the effective access of the members of the groups is written as derived relationships.
+        """
+
+        plan = self.plan(analyses, domain, domain_sid, ingestor)
+        edges = set(plan["edges"])
+        stale_edges, stale_members = self.delta(plan, domain_sid, ingestor == "bh-ce")
+
+        rows = {
+            "edges": self.edge_rows(plan),
+            "local_groups": self.local_group_rows(plan),
+            "properties": self.property_rows(plan),
+            "stale_edges": self.edge_rows({"edges": stale_edges}) if prune else [],
+            "stale_local_groups": (
+                [
+                    {"trustee": trustee, "computer": computer, "group_id": group_id}
+                    for trustee, computer, group_id in sorted(stale_members)
+                ]
+                if prune
+                else []
+            ),
+            "derived_edges": [],
+            "stale_derived_edges": [],
+            "output": self.serialize_output(plan["output"]),
+        }
+
+        if summary_edges:
+            rows["derived_edges"], rows["stale_derived_edges"] = self.derive(edges, domain_sid)
+
+        # Stored before writing, to resume the enrichment if it is interrupted
+        if self.bloodhound.checkpoint:
+            self.bloodhound.checkpoint.save_plan(domain, rows)
+
+        self.write(domain, rows)
+        return plan["output"]
+
+    def resume(self, domain):
+        """
+        Write the remaining batches of the stored enrichment plan of a domain
+        """
+        rows = self.bloodhound.checkpoint.load_plan(domain)
+        logging.info("Resuming the enrichment of %s from its last written batch", domain)
+
+        self.write(domain, rows)
+        return self.load_output(rows["output"])
+
+    def completed(self, domain):
+        """
+        Output of the stored enrichment plan of a domain entirely written by an interrupted run
+        """
+        rows = self.bloodhound.checkpoint.load_plan(domain)
+        logging.info("Skipping the enrichment of %s, written before the interruption", domain)
 
-        return output_enrichment
+        return self.load_output(rows["output"])
+
+    def write(self, domain, rows):
+        """
+        Write the rows of an enrichment plan, the batches already written by an interrupted run are skipped
+        """
+
+        logging.debug(
+            "Writing %s missing relationships, %s local group memberships and %s properties for %s",
+            len(rows["edges"]),
+            len(rows["local_groups"]),
+            len(rows["properties"]),
+            domain,
+        )
+
+        if self.bloodhound.checkpoint:
+            self.bloodhound.checkpoint.begin(domain)
+
+        self.bloodhound.merge_edges(rows["edges"])
+
+        # A failure propagates like the other writes, the domain stays pending for --resume
+        if rows["local_groups"]:
+            self.bloodhound.merge_local_groups(rows["local_groups"])
+
+        self.bloodhound.set_properties(rows["properties"])
+
+        if rows["derived_edges"] or rows["stale_derived_edges"]:
+            logging.info(
+                "Writing %s and removing %s effective access relationships derived for %s",
+                len(rows["derived_edges"]),
+                len(rows["stale_derived_edges"]),
+                domain,
+            )
+            self.bloodhound.merge_edges(rows["derived_edges"], derived=True)
+            self.bloodhound.delete_edges(rows["stale_derived_edges"], derived=True)
+
+        if rows["stale_edges"]:
+            logging.info(
+                "Removing %s relationships no longer justified by the GPOs of %s", len(rows["stale_edges"]), domain
+            )
+            self.bloodhound.delete_edges(rows["stale_edges"])
+
+        if rows.get("stale_local_groups"):
+            logging.info(
+                "Removing %s local group memberships no longer justified by the GPOs of %s",
+                len(rows["stale_local_groups"]),
+                domain,
+            )
+            self.bloodhound.delete_local_groups(rows["stale_local_groups"])
+
+        if self.bloodhound.checkpoint:
+            self.bloodhound.checkpoint.finish(domain)
+
+    @staticmethod
+    def serialize_output(output_enrichment):
+        """
+        JSON compatible enrichment output : lists of computers, properties as [key, value, computers]
+        """
+        return {
+            "Memberships": {
+                group: {trustee: list(computers) for trustee, computers in trustees.items()}
+                for group, trustees in output_enrichment["Memberships"].items()
+            },
+            "Privilege Rights": {
+                privilege: {trustee: list(computers) for trustee, computers in trustees.items()}
+                for privilege, trustees in output_enrichment["Privilege Rights"].items()
+            },
+            "Properties": [
+                [key, value, list(computers)] for (key, value), computers in output_enrichment["Properties"].items()
+            ],
+        }
+
+    @staticmethod
+    def load_output(data):
+        """
+        Enrichment output from its JSON compatible form
+        """
+        return {
+            "Memberships": {
+                group: {trustee: set(computers) for trustee, computers in trustees.items()}
+                for group, trustees in data["Memberships"].items()
+            },
+            "Privilege Rights": {
+                privilege: {trustee: set(computers) for trustee, computers in trustees.items()}
+                for privilege, trustees in data["Privilege Rights"].items()
+            },
+            "Properties": {(key, value): set(computers) for key, value, computers in data["Properties"]},
+        }
@@ -0,0 +1,279 @@
+import os
+import csv
+import json
+import logging
+
+from gpohound.utils.bloodhound import CONSTRAINTS, RELATIONSHIP_TYPE, property_key
+
+
+class EnrichmentExporter:
+    """
+    Export the enrichment to files for bulk import instead of writing it to Neo4j
+    """
+
+    FORMATS = ["opengraph", "legacy", "cypher"]
+
+    # Local group sessions of the legacy computer JSON for each edge
+    LEGACY_GROUPS = {
+        "AdminTo": "LocalAdmins",
+        "CanRDP": "RemoteDesktopUsers",
+        "ExecuteDCOM": "DcomUsers",
+        "CanPSRemote": "PSRemoteUsers",
+    }
+
+    # Sessions of the legacy computer JSON which are not collected
+    LEGACY_SESSIONS = ["Sessions", "PrivilegedSessions", "RegistrySessions"]
+
+    def __init__(self, bloodhound_enricher):
+        self.enricher = bloodhound_enricher
+
+    def export(self, analyses, domain, domain_sid, output_dir, formats=None):
+        """
+        Build the enrichment plan of a domain and write it in the requested formats
+        """
+
+        plan = self.enricher.plan(analyses, domain, domain_sid, "bh-ce")
+
+        os.makedirs(output_dir, exist_ok=True)
+        prefix = os.path.join(output_dir, domain.lower())
+
+        for export_format in formats or self.FORMATS:
+            if export_format == "opengraph":
+                self.write_opengraph(plan, f"{prefix}_opengraph.json")
+            elif export_format == "legacy":
+                self.write_legacy(plan, f"{prefix}_computers.json")
+            elif export_format == "cypher":
+                self.write_cypher(plan, prefix)
+
+        logging.info("Enrichment of %s exported to %s", domain, output_dir)
+        return plan["output"]
+
+    def local_groups(self, plan):
+        """
+        Local groups of a plan with the relationships of their members : {objectid: (name, computer, [trustees])}
+        """
+        local_groups = {}
+        for row in self.enricher.local_group_rows(plan):
+            local_groups.setdefault(row["group_id"], (row["name"], row["computer"], []))[2].append(row["trustee"])
+        return local_groups
+
+    def write_json_array(self, file, items):
+        """
+        Write the items of a JSON array one by one
+        """
+        file.write("[")
+        for idx, item in enumerate(items):
+            if idx:
+                file.write(",")
+            file.write("\n" + json.dumps(item))
+        file.write("\n]")
+
+    def write_opengraph(self, plan, path):
+        """
+        BloodHound CE OpenGraph JSON : computers with their new properties, local groups and relationships
+        """
+
+        local_groups = self.local_groups(plan)
+
+        computer_properties = {}
+        for row in self.enricher.property_rows(plan):
+            computer_properties.setdefault(row["computer"], {})[row["key"]] = row["value"]
+
+        def nodes():
+            for computer, properties in computer_properties.items():
+                yield {"id": computer, "kinds": ["Computer", "Base"], "properties": properties}
+            for objectid, (name, _, _) in local_groups.items():
+                yield {"id": objectid, "kinds": ["ADLocalGroup", "Base"], "properties": {"name": name}}
+
+        def relationship(kind, start, end, properties=None):
+            return {
+                "kind": kind,
+                "start": {"value": start, "match_by": "id"},
+                "end": {"value": end, "match_by": "id"},
+                "properties": properties or {},
+            }
+
+        def edges():
+            for row in self.enricher.edge_rows(plan):
+                yield relationship(row["edge"], row["trustee"], row["computer"], {"gpohound": True})
+            for objectid, (_, computer, trustees) in local_groups.items():
+                yield relationship("LocalToComputer", objectid, computer)
+                for trustee in trustees:
+                    yield relationship("MemberOfLocalGroup", trustee, objectid)
+
+        with open(path, "w", encoding="utf-8") as file:
+            file.write('{"graph": {"nodes": ')
+            self.write_json_array(file, nodes())
+            file.write(', "edges": ')
+            self.write_json_array(file, edges())
+            file.write("}}\n")
+
+    def write_legacy(self, plan, path):
+        """
+        Legacy BloodHound computers JSON with the LocalAdmins, RemoteDesktopUsers, DcomUsers and PSRemoteUsers arrays.
+        The other fields of the collector are empty, and the local groups without rows are not collected,
+        so the upload only adds the enrichment to the existing computers.
+        """
+
+        computers = {}
+        skipped = set()
+        for row in self.enricher.edge_rows(plan):
+            group = self.LEGACY_GROUPS.get(row["edge"])
+            if not group:
+                skipped.add(row["edge"])
+                continue
+            object_type = self.enricher.trustee_types.get(row["trustee"]) or "Group"
+            computers.setdefault(row["computer"], {}).setdefault(group, []).append(
+                {"ObjectIdentifier": row["trustee"], "ObjectType": object_type}
+            )
+
+        properties = {}
+        for row in self.enricher.property_rows(plan):
+            properties.setdefault(row["computer"], {})[row["key"]] = row["value"]
+            computers.setdefault(row["computer"], {})
+
+        if skipped:
+            logging.debug("Relationships without a legacy JSON equivalent are not exported: %s", sorted(skipped))
+
+        def not_collected():
+            return {"Collected": False, "FailureReason": None, "Results": []}
+
+        def items():
+            for computer, groups in computers.items():
+                item = {
+                    "ObjectIdentifier": computer,
+                    "AllowedToAct": [],
+                    "PrimaryGroupSID": None,
+                    "Properties": properties.get(computer, {}),
+                    "AllowedToDelegate": [],
+                    "Aces": [],
+                    "HasSIDHistory": [],
+                    "IsDeleted": False,
+                    "Status": None,
+                    "IsACLProtected": False,
+                }
+                for group in self.LEGACY_GROUPS.values():
+                    if group in groups:
+                        item[group] = {"Collected": True, "FailureReason": None, "Results": groups[group]}
+                    else:
+                        item[group] = not_collected()
+                for sessions in self.LEGACY_SESSIONS:
+                    item[sessions] = not_collected()
+                yield item
+
+        with open(path, "w", encoding="utf-8") as file:
+            file.write('{"data": ')
+            self.write_json_array(file, items())
+            meta = {"methods": 0, "type": "computers", "count": len(computers), "version": 5}
+            file.write(', "meta": ' + json.dumps(meta) + "}\n")
+
+    @staticmethod
+    def cypher_string(value):
+        """
+        Single-quoted Cypher string literal
+        """
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+    @staticmethod
+    def value_type(value):
+        """
+        Type of a property value, to convert it back from the CSV
+        """
+        if isinstance(value, bool):
+            return "boolean"
+        if isinstance(value, int):
+            return "integer"
+        if isinstance(value, float):
+            return "float"
+        return "string"
+
+    def write_cypher(self, plan, prefix):
+        """
+        CSV files and a Cypher script applying them to an existing BloodHound database with LOAD CSV.
+        The script runs the statements of the Neo4j enrichment : the trustees and computers are matched by objectid,
+        the relationships, local groups and memberships are merged, so it can run several times.
+        """
+
+        directory, name = os.path.split(prefix)
+        files = {
+            "relationships": f"{name}_relationships.csv",
+            "local_groups": f"{name}_local_groups.csv",
+            "properties": f"{name}_computer_properties.csv",
+        }
+
+        edge_rows = self.enricher.edge_rows(plan)
+        with open(os.path.join(directory, files["relationships"]), "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["trustee", "computer", "edge"])
+            for row in edge_rows:
+                writer.writerow([row["trustee"], row["computer"], row["edge"]])
+
+        local_group_rows = self.enricher.local_group_rows(plan)
+        with open(os.path.join(directory, files["local_groups"]), "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["trustee", "computer", "group_id", "name"])
+            for row in local_group_rows:
+                writer.writerow([row["trustee"], row["computer"], row["group_id"], row["name"]])
+
+        property_rows = self.enricher.property_rows(plan)
+        with open(os.path.join(directory, files["properties"]), "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["computer", "key", "value", "type"])
+            for row in property_rows:
+                value = str(row["value"]).lower() if isinstance(row["value"], bool) else row["value"]
+                writer.writerow([row["computer"], row["key"], value, self.value_type(row["value"])])
+
+        def load(file_key):
+            return f"LOAD CSV WITH HEADERS FROM {self.cypher_string('file:///' + files[file_key])} AS row"
+
+        statements = []
+
+        # One statement per relationship type, which can't be a parameter
+        for edge in sorted({row["edge"] for row in edge_rows}):
+            if not RELATIONSHIP_TYPE.match(edge):
+                logging.error("Invalid relationship type '%s', relationships not exported", edge)
+                continue
+            statements.append(
+                f"""{load("relationships")}
+WITH row WHERE row.edge = {self.cypher_string(edge)}
+MATCH (t:Base {{objectid: row.trustee}})
+MATCH (c:Computer {{objectid: row.computer}})
+MERGE (t)-[:{edge} {{gpohound: true}}]->(c);"""
+            )
+
+        if local_group_rows:
+            for constraint, definition in CONSTRAINTS.items():
+                statements.append(f"CREATE CONSTRAINT {constraint} IF NOT EXISTS {definition};")
+            statements.append(
+                f"""{load("local_groups")}
+MATCH (c:Computer {{objectid: row.computer}})
+MERGE (g:ADLocalGroup {{objectid: row.group_id}})
+ON CREATE SET g.name = row.name, g.gpohound = true
+MERGE (g)-[:LocalToComputer]->(c);"""
+            )
+            statements.append(
+                f"""{load("local_groups")}
+MATCH (t:Base {{objectid: row.trustee}})
+MATCH (g:ADLocalGroup {{objectid: row.group_id}})
+MERGE (t)-[r:MemberOfLocalGroup]->(g)
+ON CREATE SET r.gpohound = true;"""
+            )
+
+        # One statement per property key, the values are converted back to their type
+        for key in sorted({row["key"] for row in property_rows}):
+            statements.append(
+                f"""{load("properties")}
+WITH row WHERE row.key = {self.cypher_string(key)}
+MATCH (c:Computer {{objectid: row.computer}})
+SET c.{property_key(key)} = CASE row.type
+    WHEN 'boolean' THEN toBoolean(row.value)
+    WHEN 'integer' THEN toInteger(row.value)
+    WHEN 'float' THEN toFloat(row.value)
+    ELSE row.value
+END;"""
+            )
+
+        with open(f"{prefix}_import.cypher", "w", encoding="utf-8") as file:
+            file.write("// GPOHound enrichment, copy the CSV files to the import directory of Neo4j and run :\n")
+            file.write(f"// cypher-shell -u neo4j -p <password> -f {name}_import.cypher\n\n")
+            file.write("\n\n".join(statements) + "\n")
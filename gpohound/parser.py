@@ -121,13 +121,17 @@ class GPOParser:
 
         return policy_info
 
-    def parse_domain_policies(self, sysvol_path):
+    def parse_domain_policies(self, sysvol_path, skip_domains=None):
         """
-        Extract settings from SYSVOL to dictionary
+        Extract settings from SYSVOL to dictionary, the domains to skip are listed without their GPOs
         """
         results = {}
         domain_policies_info = self.find_policy_info(sysvol_path)
         for domain, policies_info in domain_policies_info.items():
+            if skip_domains and domain.lower() in skip_domains:
+                results.setdefault(domain.lower(), {})
+                continue
+
             for policy_guid, policy_data in policies_info.items():
                 policy = self.parse_policy(policy_guid, policy_data)
                 if policy:
@@ -1,7 +1,13 @@
+import logging
+
+import yaml
 from rich.prompt import Prompt
 from rich.prompt import Confirm
 
 from gpohound.utils.utils import load_yaml_config
+from gpohound.utils.bloodhound import normalize_guid
+from gpohound.utils.topology import DomainTopology
+from gpohound.utils.closure import MembershipClosure
 
 
 class ActiveDirectoryUtils:
@@ -14,10 +20,34 @@ class ActiveDirectoryUtils:
         bloodhound_connector,
         config="config",
         config_file="well_known_groups.yaml",
+        cache=None,
+        non_interactive=False,
     ):
         self.config_trustee = load_yaml_config(config, config_file)
         self.bloodhound = bloodhound_connector
+        self.cache = cache
+        self.non_interactive = non_interactive
         self.netbios_names = {}
+        self.netbios_guesses = {}
+        self.affected_containers = {}
+        self.container_machines = {}
+        self.topologies = {}
+        self.membership_closures = {}
+        self.domain_gpo_names = {}
+
+    def cached(self, kind, key, resolver):
+        """
+        Resolve a value once and keep it in the persistent cache if available
+        """
+        if self.cache is None:
+            return resolver()
+
+        value = self.cache.get(kind, key)
+        if value is self.cache.MISSING:
+            value = resolver()
+            self.cache.set(kind, key, value)
+
+        return value
 
     def node_to_dict(self, query_result, attributes=None):
         """
@@ -62,10 +92,14 @@ class ActiveDirectoryUtils:
 
         elif self.bloodhound.connection:
             # Domain group or user
-            node = self.bloodhound.find_by_objectid(sid)
 
-            if node and "samaccountname" in node["n"]:
-                return node["n"]["samaccountname"]
+            def resolver():
+                node = self.bloodhound.find_by_objectid(sid)
+                if node and node["n"].get("samaccountname"):
+                    return node["n"]["samaccountname"]
+                return None
+
+            return self.cached("sid_name", sid.upper(), resolver)
 
         return None
 
@@ -93,32 +127,91 @@ class ActiveDirectoryUtils:
             return trustee["sid"]
 
         if self.bloodhound.connection and domain_sid:
-            node = self.bloodhound.find_by_samaccountname(samaccountname, domain_sid)
-            if node and "objectid" in node["n"]:
-                return node["n"]["objectid"]
+
+            def resolver():
+                node = self.bloodhound.find_by_samaccountname(samaccountname, domain_sid)
+                if node and node["n"].get("objectid"):
+                    return node["n"]["objectid"]
+                return None
+
+            return self.cached("samaccountname_sid", f"{domain_sid}|{samaccountname}".upper(), resolver)
         return None
 
     def get_all_samaccountnames(self):
         """
-        Get all samaccountnames of any domain
+        Stream all samaccountnames of any domain
         """
         if self.bloodhound.connection:
-            nodes = self.bloodhound.all_samaccountnames()
-            if nodes:
-                return self.nodes_to_dict(nodes)
+            return self.bloodhound.all_samaccountnames()
         return None
 
+    def load_netbios_names(self, mapping_file=None):
+        """
+        Resolve NetBIOS names in bulk before processing :
+            - Entries of the mapping file (NETBIOS: domain.local)
+            - "netbios" property of the Domain nodes
+            - First label of the DNS domain name when it is not ambiguous, only a guess to confirm in interactive mode
+        """
+        netbios_names = {}
+
+        if mapping_file:
+            try:
+                with open(mapping_file, "r", encoding="utf-8") as file:
+                    mapping = yaml.safe_load(file) or {}
+            except (OSError, yaml.YAMLError) as error:
+                logging.error("Could not load the NetBIOS mapping file '%s': %s", mapping_file, error)
+                mapping = {}
+
+            if isinstance(mapping, dict):
+                for netbios_name, domain_name in mapping.items():
+                    netbios_names[str(netbios_name).upper()] = str(domain_name).lower() if domain_name else None
+            else:
+                logging.error("The NetBIOS mapping file '%s' must contain a 'NETBIOS: domain' mapping", mapping_file)
+
+        domains = self.get_domains() or []
+
+        # NetBIOS names collected with the domains
+        for domain in domains:
+            netbios_name = domain.get("netbios")
+            if netbios_name and domain.get("name"):
+                netbios_names.setdefault(netbios_name.upper(), domain["name"].lower())
+
+        # First label of the domain names
+        first_labels = {}
+        for domain in domains:
+            if domain.get("name"):
+                first_labels.setdefault(domain["name"].split(".", 1)[0].upper(), []).append(domain["name"].lower())
+
+        for netbios_name, domain_names in first_labels.items():
+            if len(domain_names) == 1 and netbios_name not in netbios_names:
+                if self.non_interactive:
+                    netbios_names[netbios_name] = domain_names[0]
+                else:
+                    self.netbios_guesses[netbios_name] = domain_names[0]
+
+        self.netbios_names.update(netbios_names)
+        logging.debug("Resolved %s NetBIOS names before processing", len(netbios_names))
+
     def netbios_to_domain(self, netbios_name):
         """
         Netbios name to a domain name
         """
         netbios_name = netbios_name.upper()
+        if netbios_name not in self.netbios_names and self.cache is not None:
+            cached_domain = self.cache.get("netbios_domain", netbios_name)
+            if cached_domain is not self.cache.MISSING:
+                self.netbios_names[netbios_name] = cached_domain
+
         if netbios_name in self.netbios_names:
             return self.netbios_names.get(netbios_name)
         elif "%" in netbios_name:
             return None
         elif netbios_name in ["NT SERVICE", "NT AUTHORITY"]:
-            self.netbios_names.update({netbios_name: None})
+            self.set_netbios_domain(netbios_name, None)
+            return None
+        elif self.non_interactive:
+            logging.debug("Could not resolve the NetBIOS name %s without prompting", netbios_name)
+            self.netbios_names[netbios_name] = None
             return None
         else:
             domains = self.get_domains()
@@ -135,35 +228,47 @@ class ActiveDirectoryUtils:
                 )
 
                 if confirm_domain:
-                    self.netbios_names.update({netbios_name: domain_name})
+                    self.set_netbios_domain(netbios_name, domain_name)
                     return domain_name
                 else:
-                    self.netbios_names.update({netbios_name: None})
+                    self.set_netbios_domain(netbios_name, None)
 
             else:
                 prompt_string = f"[bold][underline]Enter the domain associated with the NetBIOS name [green]{netbios_name}[/green]:[/underline]\n  0. Not found[/bold]"
                 domains_dict = {"0": None}
 
+                # Domain guessed from the first label of its name, proposed as the default choice
+                default = None
                 for idx, domain in enumerate(domains, start=1):
                     domain_name = domain["name"].lower()
                     domains_dict.update({str(idx): domain_name})
                     prompt_string += f"\n[bold]  {idx}. " + domain_name + "[/bold]"
+                    if domain_name == self.netbios_guesses.get(netbios_name):
+                        default = str(idx)
 
                 domain_idx = Prompt.ask(
                     prompt_string + "\n",
                     choices=domains_dict.keys(),
-                    default=None,
+                    default=default,
                     show_choices=False,
                 )
 
                 if domain_idx:
                     output_domain_name = domains_dict.get(domain_idx)
-                    self.netbios_names.update({netbios_name: output_domain_name})
+                    self.set_netbios_domain(netbios_name, output_domain_name)
                     return output_domain_name
                 else:
-                    self.netbios_names.update({netbios_name: None})
+                    self.set_netbios_domain(netbios_name, None)
         return None
 
+    def set_netbios_domain(self, netbios_name, domain_name):
+        """
+        Remember the domain associated with a NetBIOS name
+        """
+        self.netbios_names[netbios_name] = domain_name
+        if self.cache is not None:
+            self.cache.set("netbios_domain", netbios_name, domain_name)
+
     def get_trustee(self, trustee, domain_sid=None):
         """
         Get trustee based on name or sid
@@ -219,10 +324,9 @@ class ActiveDirectoryUtils:
                 sid = self.samaccountname_to_sid(name, domain_sid)
 
             if sid and name and domain_sid:
-                domain = self.find_by_sid(domain_sid)
+                domain_name = self.sid_to_domain(domain_sid)
 
-                if domain:
-                    domain_name = domain.get("name")
+                if domain_name:
                     trustee_output["name"] = f"{name}@{domain_name}"
                     trustee_output["sid"] = sid.replace(f"{domain_name.upper()}-", "")
                     trustee_output["domain_sid"] = domain_sid
@@ -275,10 +379,10 @@ class ActiveDirectoryUtils:
         if self.bloodhound.connection:
             node = self.bloodhound.find_by_gpo_guid(guid, domain_sid)
 
-            if node and "name" in node["n"]:
+            if node and node["n"].get("name"):
                 output = self.node_to_dict(node, attributes)
 
-                if "name" in output:
+                if output.get("name"):
                     output["name"] = output["name"].rsplit("@", 1)[0]
 
                 return output
@@ -301,69 +405,187 @@ class ActiveDirectoryUtils:
         Domain name to sid
         """
         if self.bloodhound.connection:
-            result = self.bloodhound.find_by_domain_name(domain)
-            if result and "objectid" in result["n"]:
-                return result["n"]["objectid"]
 
-    def container_inheritance(self, container_id):
+            def resolver():
+                result = self.bloodhound.find_by_domain_name(domain)
+                if result and result["n"].get("objectid"):
+                    return result["n"]["objectid"]
+                return None
+
+            return self.cached("domain_sid", domain.upper(), resolver)
+
+        return None
+
+    def sid_to_domain(self, domain_sid):
+        """
+        Domain sid to domain name
+        """
+        if self.bloodhound.connection:
+
+            def resolver():
+                result = self.bloodhound.find_by_objectid(domain_sid.strip("*"))
+                if result and result["n"].get("name"):
+                    return result["n"]["name"]
+                return None
+
+            return self.cached("domain_name", domain_sid.upper(), resolver)
+
+        return None
+
+    def container_inheritance(self, container_id, domain_sid=None):
         """
-        Get GPO application order (inheritance)
+        Get GPO application order (inheritance), from the container tree of the domain when it is known
         """
 
         if self.bloodhound.connection:
+            if domain_sid:
+                topology = self.get_topology(domain_sid)
+                if container_id in topology.containers:
+                    return topology.gpo_inheritance(container_id) or None
+
             gpo_inheritance = self.bloodhound.get_gpo_inheritance(container_id)
             if gpo_inheritance:
                 return self.nodes_to_dict(gpo_inheritance)
 
         return None
 
-    def get_containers(self, domain_sid):
+    def get_topology(self, domain_sid):
         """
-        Get all the containers of a domain
+        Load the container tree of a domain once per run
         """
+        if domain_sid not in self.topologies:
+            self.topologies[domain_sid] = DomainTopology(self.bloodhound.get_domain_topology(domain_sid))
+            logging.debug(
+                "Loaded %s containers of the domain %s", len(self.topologies[domain_sid].containers), domain_sid
+            )
 
-        if self.bloodhound.connection:
-            results = self.bloodhound.get_containers(domain_sid)
-            if results:
-                return self.nodes_to_dict(results)
+        return self.topologies[domain_sid]
+
+    def get_membership_closure(self, domain_sid):
+        """
+        Load the group memberships of a domain once per run
+        """
+        if domain_sid not in self.membership_closures:
+            self.membership_closures[domain_sid] = MembershipClosure(self.bloodhound.get_domain_memberships(domain_sid))
+            logging.debug(
+                "Loaded %s groups with members of the domain %s",
+                len(self.membership_closures[domain_sid].direct),
+                domain_sid,
+            )
+
+        return self.membership_closures[domain_sid]
+
+    def effective_counts(self, sid, domain_sid):
+        """
+        Number of users and computers a trustee gives access to, through its transitive members for a group
+        """
+        if not self.bloodhound.connection or not sid or not domain_sid:
+            return None
+
+        closure = self.get_membership_closure(domain_sid)
+        for objectid in self.bloodhound.trustee_objectids([sid]):
+            counts = closure.counts(objectid)
+            if counts:
+                return counts
 
         return None
 
+    def prefetch_affected_containers(self, gpo_guids, domain_sid):
+        """
+        Compute the containers affected by every GPO of a domain in one pass over the container tree
+        """
+
+        if not any((guid, domain_sid) not in self.affected_containers for guid in gpo_guids):
+            return
+
+        affected = self.get_topology(domain_sid).affected_containers()
+        for guid in gpo_guids:
+            containers = affected.get((normalize_guid(guid), domain_sid.upper()))
+            self.affected_containers[(guid, domain_sid)] = [dict(container) for container in containers] if containers else None
+
     def get_containers_affected_by_gpo(self, gpo_guid, domain_sid):
         """
         Get containers (Domain, OU, Container) affected by a GPO
         """
 
         if self.bloodhound.connection:
-            results = self.bloodhound.containers_affected_by_gpo(gpo_guid, domain_sid)
-            if results:
-                return self.nodes_to_dict(results)
+            self.prefetch_affected_containers([gpo_guid], domain_sid)
+            return self.affected_containers[(gpo_guid, domain_sid)]
 
         return None
 
+    def prefetch_machines_in_containers(self, container_ids, domain_sid):
+        """
+        Get the machines of several containers from the computers of the domain, loaded once per run
+        """
+
+        missing = [
+            container_id
+            for container_id in dict.fromkeys(container_ids)
+            if (container_id, domain_sid) not in self.container_machines
+        ]
+        if not missing:
+            return
+
+        topology = self.get_topology(domain_sid)
+        if topology.machines is None:
+            topology.load_machines(self.bloodhound.get_domain_computers(domain_sid))
+
+        for container_id in missing:
+            machines = topology.machines_in_container(container_id) if container_id in topology.containers else []
+            self.container_machines[(container_id, domain_sid)] = machines or None
+
     def get_machines_in_container(self, container_id, domain_sid):
         """
         Get machines in a container
         """
 
         if self.bloodhound.connection:
-            results = self.bloodhound.machines_in_container(container_id, domain_sid)
-            if results:
-                return self.nodes_to_dict(results)
+            self.prefetch_machines_in_containers([container_id], domain_sid)
+            return self.container_machines[(container_id, domain_sid)]
 
         return None
 
-    def get_machines_affected_by_gpo(self, gpo_guid, domain_sid):
+    def get_gpo_names(self, guids, domain_sid):
         """
-        Get machines affected by a GPO
+        Get the names of several GPOs, the GPOs missing from the cache are resolved with all the GPOs of the domain
         """
 
-        if self.bloodhound.connection:
-            results = self.bloodhound.machines_affected_by_gpo(gpo_guid, domain_sid)
-            if results:
-                return self.nodes_to_dict(results)
+        names = {}
+        missing = []
+        for guid in guids:
+            name = self.cache.get("gpo_name", f"{domain_sid}|{guid}".upper()) if self.cache is not None else None
+            if self.cache is None or name is self.cache.MISSING:
+                missing.append(guid)
+            else:
+                names[guid] = name
 
-        return None
+        if missing:
+            domain_gpos = self.get_domain_gpo_names(domain_sid)
+            for guid in missing:
+                name = domain_gpos.get(normalize_guid(guid))
+                names[guid] = name
+                if self.cache is not None:
+                    self.cache.set("gpo_name", f"{domain_sid}|{guid}".upper(), name)
+
+        return names
+
+    def get_domain_gpo_names(self, domain_sid):
+        """
+        GUID to name map of the GPOs of a domain, built from one query per domain
+        """
+
+        if domain_sid not in self.domain_gpo_names:
+            gpo_names = {}
+            for gpo in self.bloodhound.get_gpos(domain_sid):
+                guid = gpo.get("guid")
+                if not guid and "{" in (gpo.get("gpcpath") or ""):
+                    guid = gpo["gpcpath"].split("{", 1)[1].split("}")[0]
+                if guid and gpo.get("name"):
+                    gpo_names[normalize_guid(guid)] = gpo["name"].rsplit("@", 1)[0]
+            self.domain_gpo_names[domain_sid] = gpo_names
+
+        return self.domain_gpo_names[domain_sid]
 
     def resolve_gpo_name(self, domainpolicies):
         """
@@ -373,11 +595,12 @@ class ActiveDirectoryUtils:
             domain_sid = self.domain_to_sid(domain)
             if domain_sid:
                 guids = list(gpos.keys())
+                names = self.get_gpo_names(guids, domain_sid)
                 for guid in guids:
-                    gpo = self.find_by_gpo_guid(guid, domain_sid)
-                    if gpo:
+                    name = names.get(guid)
+                    if name:
                         # Move Name to the top of the dictionary
-                        gpo_with_name = {"GPO Name": gpo.get("name")}
+                        gpo_with_name = {"GPO Name": name}
                         gpo_with_name.update(domainpolicies[domain][guid])
                         domainpolicies[domain][guid] = gpo_with_name
         return domainpolicies
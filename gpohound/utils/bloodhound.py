@@ -1,35 +1,149 @@
+import re
+import time
 import logging
-from neo4j import GraphDatabase
-from neo4j.exceptions import ServiceUnavailable, AuthError, CypherSyntaxError
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from neo4j import GraphDatabase, READ_ACCESS
+from neo4j.exceptions import ServiceUnavailable, AuthError, CypherSyntaxError, ClientError
+
+from gpohound.utils.cache import QueryMemo
+from gpohound.utils.query_stats import QueryStats
 
 logging.getLogger("neo4j").setLevel(logging.INFO)
 
+# Indexes created by "gpohound db prepare"
+INDEXES = {
+    "gpohound_base_objectid": "FOR (n:Base) ON (n.objectid)",
+    "gpohound_base_domainsid": "FOR (n:Base) ON (n.domainsid)",
+    "gpohound_base_name": "FOR (n:Base) ON (n.name)",
+    "gpohound_base_distinguishedname": "FOR (n:Base) ON (n.distinguishedname)",
+    "gpohound_base_samaccountname": "FOR (n:Base) ON (n.gpohound_samaccountname)",
+    "gpohound_domain_domain": "FOR (n:Domain) ON (n.domain)",
+    "gpohound_gpo_guid": "FOR (n:GPO) ON (n.gpohound_guid)",
+}
+
+# Constraints created by "gpohound db prepare" and before the first write of local groups
+CONSTRAINTS = {
+    "gpohound_adlocalgroup_objectid": "FOR (n:ADLocalGroup) REQUIRE n.objectid IS UNIQUE",
+}
+
+# Properties returned for each kind of node, the callers only use these
+DOMAIN_PROPERTIES = ("objectid", "name", "domain", "netbios")
+GPO_PROPERTIES = ("objectid", "name", "gpcpath", "domainsid")
+ACCOUNT_PROPERTIES = ("objectid", "name", "samaccountname", "distinguishedname", "domainsid")
+CONTAINER_PROPERTIES = ("objectid", "name", "distinguishedname", "domainsid", "blocksinheritance")
+
+# Relationship types written in the enrichment statements
+RELATIONSHIP_TYPE = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+
+
+def projection(variable, properties):
+    """
+    Cypher map projection of the properties of a node : n {.objectid, .name}
+    """
+    return variable + " {" + ", ".join("." + prop for prop in properties) + "}"
+
+
+def property_key(key):
+    """
+    Backtick-quoted property key for a Cypher statement : c.`TightVNC Control Password`
+    """
+    return "`" + key.replace("`", "``") + "`"
+
+
+def group_rows(rows, key):
+    """
+    Group write rows by the value of one of their keys
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[key], []).append(row)
+    return groups
+
+
+def normalize_guid(guid):
+    """
+    Format a GPO GUID as stored in BloodHound : {GUID} in upper case
+    """
+    return "{" + guid.upper().strip("{").strip("}") + "}"
+
 
 class BloodHoundConnector:
     """
     Class to interact with BloodHound data
     """
 
-    def __init__(self, host=None, user=None, password=None, port=None):
+    offline = False
+
+    def __init__(
+        self,
+        host=None,
+        user=None,
+        password=None,
+        port=None,
+        pool_size=None,
+        fetch_size=None,
+        query_cache_size=None,
+        write_batch_size=None,
+        chunked_writes=False,
+        write_concurrency=None,
+        profile=False,
+    ):
         self.uri = f"bolt://{host}:{port}"
         self.user = user
         self.password = password
         self.apoc = None
+        self.prepared = False
+        self.accounts_prepared = None
+        self.domain_names = None
+        self.constraints_ensured = False
+
+        # Calls, latency and rows of each query, PROFILE plans with "--profile-queries"
+        self.query_stats = QueryStats(profile)
+
+        # Results of the read queries already run
+        self.query_memo = QueryMemo(query_cache_size)
+
+        # Rows per enrichment write query
+        self.write_batch_size = write_batch_size or 10000
+        self.chunked_writes = chunked_writes
+
+        # Sessions writing the enrichment concurrently, each one on its own computers
+        self.write_concurrency = write_concurrency or 1
+
+        # Enrichment plans and log of the written batches, to resume an interrupted enrichment
+        self.checkpoint = None
+
+        # Explicit read transaction shared by the queries of a "read_transaction" context
+        self.transaction = None
+
+        # Driver and session settings
+        self.driver_config = {}
+        if pool_size:
+            self.driver_config["max_connection_pool_size"] = pool_size
+
+        self.session_config = {}
+        if fetch_size:
+            self.session_config["fetch_size"] = fetch_size
 
         try:
             # Create driver
-            self.driver = GraphDatabase.driver(self.uri, auth=(self.user, self.password))
+            self.driver = GraphDatabase.driver(self.uri, auth=(self.user, self.password), **self.driver_config)
 
             # Test connection
-            self.connection = bool(self.query("RETURN 1"))
+            self.connection = bool(self.query("RETURN 1", name="connect"))
 
             # Check if APOC is available
             try:
-                self.apoc = bool(self.query("RETURN apoc.version()"))
+                self.apoc = bool(self.query("RETURN apoc.version()", name="connect"))
             except CypherSyntaxError as error:
                 logging.debug("APOC plugin not available: %s", error)
                 self.apoc = False
 
+            # Check if the derived properties of "gpohound db prepare" are up to date, the accounts on the first miss
+            self.prepared = self.is_prepared()
+
         except ServiceUnavailable as error:
             logging.debug("Unable to connect to Neo4j instance: %s", error)
             self.connection = False
@@ -39,103 +153,370 @@ class BloodHoundConnector:
             self.connection = False
             self.driver = None
 
-    def query(self, query_str, params=None):
+    def query(self, query_str, params=None, write=False, name="query"):
         """
         Execute query on the neo4j database
+        Read queries run in the shared transaction if a "read_transaction" context is active
+        The name of the query identifies its statistics and memoized results
         """
 
         if params is None:
             params = {}
 
-        with self.driver.session() as session:
-            result = session.run(query_str, params)
+        # Read queries are memoized, writes invalidate the memoized results
+        if write:
+            self.query_memo.clear()
+        else:
+            memo_key = self.query_memo.key(name, query_str, params)
+            memoized = self.query_memo.get(memo_key)
+            if memoized is not QueryMemo.MISSING:
+                return memoized
+
+        profile = self.query_stats.should_profile(query_str, write)
+        run_str = "PROFILE " + query_str if profile else query_str
+        start = time.perf_counter()
+
+        if self.transaction is not None and not write:
+            result = self.transaction.run(run_str, params)
             result_data = [record for record in result]
+            summary = result.consume() if profile else None
+        else:
+            with self.driver.session(**self.session_config) as session:
+                result = session.run(run_str, params)
+                result_data = [record for record in result]
+                summary = result.consume() if profile else None
+
+        self.query_stats.record(name, time.perf_counter() - start, len(result_data))
+        if summary:
+            self.query_stats.record_plan(name, query_str, summary.profile)
+
+        if result_data:
+            if len(result_data) == 1:
+                result_data = result_data[0]
+        else:
+            result_data = None
+
+        if not write:
+            self.query_memo.set(memo_key, result_data)
+
+        return result_data
+
+    def stream(self, query_str, params=None, name="stream"):
+        """
+        Stream the records of a read query as dictionaries
+        Records are fetched by batch of "fetch_size" while iterating, so they are never all held in memory
+        """
+
+        if params is None:
+            params = {}
+
+        return self.stream_records(name, query_str, params)
+
+    def stream_records(self, name, query_str, params):
+        """
+        Generator running a streamed query
+        """
+
+        profile = self.query_stats.should_profile(query_str)
+        run_str = "PROFILE " + query_str if profile else query_str
+        start = time.perf_counter()
+        rows = 0
+
+        with self.driver.session(default_access_mode=READ_ACCESS, **self.session_config) as session:
+            result = session.run(run_str, params)
+            for record in result:
+                rows += 1
+                yield record.data()
+
+            if profile:
+                self.query_stats.record_plan(name, query_str, result.consume().profile)
+
+        # Includes the time spent by the caller between the batches
+        self.query_stats.record(name, time.perf_counter() - start, rows)
 
-            if result_data:
-                if len(result_data) == 1:
-                    return result_data[0]
-                else:
-                    return result_data
-        return None
+    @contextmanager
+    def read_transaction(self):
+        """
+        Run the read queries of the context in a single session and transaction
+        """
+
+        # Already in a transaction or nothing to connect to
+        if self.transaction is not None or not self.connection:
+            yield
+            return
+
+        with self.driver.session(default_access_mode=READ_ACCESS, **self.session_config) as session:
+            with session.begin_transaction() as transaction:
+                self.transaction = transaction
+                try:
+                    yield
+                finally:
+                    self.transaction = None
 
     def close(self):
         if self.driver:
             self.driver.close()
 
+    def is_prepared(self):
+        """
+        Check if every GPO has the derived properties created by "gpohound db prepare"
+        """
+        query = """
+                MATCH (n:GPO)
+                RETURN count(n) AS gpos, count(n.gpohound_guid) AS prepared
+                """
+
+        result = self.query(query, name="is_prepared")
+        if result and result["gpos"]:
+            if result["gpos"] == result["prepared"]:
+                return True
+            if result["prepared"]:
+                logging.warning("New BloodHound data was imported, run 'gpohound db prepare' again to use the indexes")
+        return False
+
+    def are_accounts_prepared(self):
+        """
+        Check if every account has an up to date upper case sAMAccountName created by "gpohound db prepare",
+        accounts imported or renamed since then are not found by the exact-match lookups
+        """
+        query = """
+                MATCH (n:Base)
+                WHERE n.samaccountname IS NOT NULL
+                RETURN count(n) AS accounts,
+                    count(CASE WHEN n.gpohound_samaccountname = toUpper(n.samaccountname) THEN 1 END) AS prepared
+                """
+
+        result = self.query(query, name="are_accounts_prepared")
+        if result and result["accounts"]:
+            if result["accounts"] == result["prepared"]:
+                return True
+            if result["prepared"]:
+                logging.warning(
+                    "%s accounts were imported or renamed, run 'gpohound db prepare' again to use the indexes",
+                    result["accounts"] - result["prepared"],
+                )
+        return False
+
+    def prepare(self):
+        """
+        Create the indexes and the upper case derived properties used for exact-match lookups
+        """
+
+        for name, definition in INDEXES.items():
+            try:
+                self.query(f"CREATE INDEX {name} IF NOT EXISTS {definition}", write=True, name="prepare")
+            except ClientError as error:
+                logging.debug("Could not create index %s: %s", name, error)
+
+        self.ensure_constraints()
+
+        # GPO GUID extracted from the gpcpath ("{GUID}" in upper case)
+        self.query(
+            """
+            MATCH (n:GPO)
+            CALL {
+                WITH n
+                SET n.gpohound_guid = CASE
+                    WHEN n.gpcpath CONTAINS '{' THEN toUpper('{' + split(split(n.gpcpath, '{')[1], '}')[0] + '}')
+                    ELSE ''
+                END
+            } IN TRANSACTIONS OF 10000 ROWS
+            """,
+            write=True,
+            name="prepare",
+        )
+
+        # sAMAccountName in upper case
+        self.query(
+            """
+            MATCH (n:Base)
+            WHERE n.samaccountname IS NOT NULL
+            CALL {
+                WITH n
+                SET n.gpohound_samaccountname = toUpper(n.samaccountname)
+            } IN TRANSACTIONS OF 10000 ROWS
+            """,
+            write=True,
+            name="prepare",
+        )
+
+        self.query("CALL db.awaitIndexes(300)", name="prepare")
+
+        result = self.query(
+            """
+            CALL { MATCH (n:GPO) RETURN count(n.gpohound_guid) AS gpos }
+            CALL { MATCH (n:Base) RETURN count(n.gpohound_samaccountname) AS accounts }
+            RETURN gpos, accounts
+            """,
+            name="prepare",
+        )
+
+        self.prepared = self.is_prepared()
+        self.accounts_prepared = True
+        return dict(result) if result else {}
+
+    def ensure_constraints(self):
+        """
+        Create the uniqueness constraints once per connection, an existing equivalent index or constraint is kept
+        """
+        if self.constraints_ensured:
+            return
+
+        for name, definition in CONSTRAINTS.items():
+            try:
+                self.query(
+                    f"CREATE CONSTRAINT {name} IF NOT EXISTS {definition}", write=True, name="ensure_constraints"
+                )
+            except ClientError as error:
+                logging.debug("Could not create constraint %s: %s", name, error)
+
+        self.constraints_ensured = True
+
+    def gpo_match(self, variable="n"):
+        """
+        Match a GPO by "$gpo_guid" ({GUID} in upper case) and "$domain_sid"
+        """
+        if self.prepared:
+            return f"""
+                MATCH ({variable}:GPO {{gpohound_guid: $gpo_guid}})
+                WHERE {variable}.domainsid = $domain_sid
+                """
+
+        return f"""
+                MATCH ({variable}:GPO)
+                WHERE toUpper({variable}.gpcpath) CONTAINS $gpo_guid AND {variable}.domainsid = $domain_sid
+                """
+
+    def trustee_objectids(self, trustee_sids):
+        """
+        Get the objectids of trustees, BloodHound prefixes well-known SIDs with the domain name (DOMAIN.LOCAL-S-1-5-32-544)
+        """
+        if self.domain_names is None:
+            result = self.query("MATCH (n:Domain) RETURN collect(n.name) AS names", name="trustee_objectids")
+            self.domain_names = [name.upper() for name in result["names"] if name] if result else []
+
+        objectids = []
+        for sid in trustee_sids:
+            sid = sid.upper()
+            objectids.append(sid)
+            if not sid.startswith("S-1-5-21-"):
+                objectids.extend(f"{domain_name}-{sid}" for domain_name in self.domain_names)
+
+        return objectids
+
+    def fingerprint(self):
+        """
+        Get data identifying the imported BloodHound collection
+        """
+        query = """
+                CALL { MATCH (d:Domain) WITH d ORDER BY d.objectid RETURN collect(d {.objectid, .name, .lastseen}) AS domains }
+                CALL { MATCH (n:User) RETURN count(n) AS users }
+                CALL { MATCH (n:Computer) RETURN count(n) AS computers }
+                CALL { MATCH (n:Group) RETURN count(n) AS groups }
+                CALL { MATCH (n:GPO) RETURN count(n) AS gpos }
+                RETURN domains, users, computers, groups, gpos
+                """
+
+        result = self.query(query, name="fingerprint")
+        return dict(result) if result else {}
+
     def find_domains(self):
         """
         Find all domains
         """
         query = """
                 MATCH (n:Domain) 
-                RETURN n
+                RETURN """ + projection("n", DOMAIN_PROPERTIES) + """ AS n
                 """
-        return self.query(query)
+        return self.query(query, name="find_domains")
 
     def find_by_domain_name(self, domain):
         """
         Find domain by by domain name
         """
-        params = {"domain": domain}
+        params = {"domain": domain.upper()}
         query = """
-                MATCH (n:Domain {domain:toUpper($domain)}) 
-                RETURN n LIMIT 1
+                MATCH (n:Domain {domain: $domain})
+                RETURN """ + projection("n", DOMAIN_PROPERTIES) + """ AS n LIMIT 1
                 """
 
-        return self.query(query, params)
+        return self.query(query, params, name="find_by_domain_name")
 
     def find_by_gpo_guid(self, gpo_guid, domain_sid):
         """
         Find a GPO with his GUID and domain SID
         """
-        params = {"gpo_guid": gpo_guid, "domain_sid": domain_sid}
+        params = {"gpo_guid": normalize_guid(gpo_guid), "domain_sid": domain_sid.upper()}
+        query = self.gpo_match("n") + """
+                RETURN """ + projection("n", GPO_PROPERTIES) + """ AS n LIMIT 1
+                """
+
+        return self.query(query, params, name="find_by_gpo_guid")
+
+    def get_gpos(self, domain_sid):
+        """
+        Stream the GUID and name of all the GPOs of a domain
+        """
+        params = {"domain_sid": domain_sid.upper()}
         query = """
-                MATCH (n:GPO) 
-                WHERE toUpper(n.gpcpath) CONTAINS toUpper($gpo_guid) and toUpper(n.domainsid) = toUpper($domain_sid)
-                RETURN n LIMIT 1
+                MATCH (n:GPO {domainsid: $domain_sid})
+                RETURN n.gpohound_guid AS guid, n.gpcpath AS gpcpath, n.name AS name
                 """
 
-        return self.query(query, params)
+        return self.stream(query, params, name="get_gpos")
 
     def find_by_samaccountname(self, samaccountname, domain_sid):
         """
         Find an object with a samaccountname
         """
-        params = {"samaccountname": samaccountname, "domain_sid": domain_sid}
+        params = {"samaccountname": samaccountname.upper(), "domain_sid": domain_sid.upper()}
+
+        if self.accounts_prepared is not False:
+            query = """
+                    MATCH (n:Base {gpohound_samaccountname: $samaccountname})
+                    WHERE n.domainsid = $domain_sid AND (n:User OR n:Group OR n:Computer)
+                    RETURN """ + projection("n", ACCOUNT_PROPERTIES) + """ AS n LIMIT 1
+                    """
+            result = self.query(query, params, name="find_by_samaccountname")
+
+            # On the first miss, check once if accounts were imported or renamed since "gpohound db prepare"
+            if result or self.accounts_prepared:
+                return result
+            self.accounts_prepared = self.are_accounts_prepared()
+            if self.accounts_prepared:
+                return result
+
         query = """
-                MATCH (n)
-                WHERE ANY(label IN labels(n) WHERE label IN ['User', 'Group', 'Computer'])
-                AND toUpper(n.samaccountname) = toUpper($samaccountname) and toUpper(n.domainsid) = toUpper($domain_sid)
-                RETURN n LIMIT 1
+                MATCH (n:Base {domainsid: $domain_sid})
+                WHERE (n:User OR n:Group OR n:Computer) AND toUpper(n.samaccountname) = $samaccountname
+                RETURN """ + projection("n", ACCOUNT_PROPERTIES) + """ AS n LIMIT 1
                 """
 
-        return self.query(query, params)
+        return self.query(query, params, name="find_by_samaccountname")
 
     def all_samaccountnames(self):
         """
-        Return all the sAMAccountName
+        Stream all the sAMAccountName with their objectid
         """
         query = """
-                MATCH (n)
-                WHERE ANY(label IN labels(n) WHERE label IN ['User', 'Group', 'Computer'])
-                AND n.samaccountname IS NOT NULL 
-                RETURN n {.samaccountname, .objectid } AS n
+                MATCH (n:Base)
+                WHERE (n:User OR n:Group OR n:Computer) AND n.samaccountname IS NOT NULL
+                RETURN n.samaccountname AS samaccountname, n.objectid AS objectid
                 """
 
-        return self.query(query)
+        return self.stream(query, name="all_samaccountnames")
 
     def find_by_objectid(self, objectid):
         """
         Find an object by his objectid
         """
-        params = {"objectid": objectid}
+        params = {"objectid": objectid.upper()}
         query = """
-                MATCH (n)
-                WHERE toUpper(n.objectid) = toUpper($objectid)
-                RETURN n LIMIT 1
+                MATCH (n:Base {objectid: $objectid})
+                RETURN """ + projection("n", ACCOUNT_PROPERTIES) + """ AS n LIMIT 1
                 """
 
-        return self.query(query, params)
+        return self.query(query, params, name="find_by_objectid")
 
     def find_container(self, target):
         """
@@ -143,13 +524,13 @@ class BloodHoundConnector:
         """
         params = {"target": target.upper()}
         query = """
-                MATCH (n)
-                WHERE ANY(label IN labels(n) WHERE label IN ['Container', 'Domain', 'OU'])
-                AND (toUpper(n.distinguishedname) = $target OR toUpper(n.objectid) = $target) 
-                RETURN n LIMIT 1
+                MATCH (n:Base)
+                WHERE (n.distinguishedname = $target OR n.objectid = $target)
+                AND (n:Container OR n:Domain OR n:OU)
+                RETURN """ + projection("n", CONTAINER_PROPERTIES) + """ AS n LIMIT 1
                 """
 
-        return self.query(query, params)
+        return self.query(query, params, name="find_container")
 
     def find_trustee_container(self, target):
         """
@@ -157,23 +538,24 @@ class BloodHoundConnector:
         """
         params = {"target": target.upper()}
         query = """
+                MATCH (t:Base)
+                WHERE (t.distinguishedname = $target OR t.objectid = $target OR t.name = $target)
+                AND (t:User OR t:Computer)
                 MATCH (n)-[r1:Contains]->(t)
-                WHERE ANY(label IN labels(t) WHERE label IN ['User', 'Computer'])
-                AND ANY(label IN labels(n) WHERE label IN ['Container', 'Domain', 'OU'])
-                AND (toUpper(t.distinguishedname) = $target OR toUpper(t.objectid) = $target OR toUpper(t.name) = $target)
-                RETURN n LIMIT 1
+                WHERE n:Container OR n:Domain OR n:OU
+                RETURN """ + projection("n", CONTAINER_PROPERTIES) + """ AS n LIMIT 1
                 """
 
-        return self.query(query, params)
+        return self.query(query, params, name="find_trustee_container")
 
     # Disabled links fix in https://github.com/dirkjanm/BloodHound.py/pull/218
     def get_gpo_inheritance(self, objectid):
         """
         Get GPO application order for a container
         """
-        params = {"objectid": objectid}
+        params = {"objectid": objectid.upper()}
         query = """
-                MATCH (o {objectid: $objectid}) 
+                MATCH (o:Base {objectid: $objectid})
                 WITH o
 
                 // Collect direct GPLinks first
@@ -208,7 +590,7 @@ class BloodHoundConnector:
                 // Sorting logic: 
                 // Enforced relationships first (by enforced DESC), then by distance DESC, then GPLink ID DESC
                 // Non-enforced relationships second, by distance ASC, then GPLink ID DESC
-                WITH result
+                WITH result, result.node AS g
                 ORDER BY 
                 result.enforced DESC, 
                 CASE WHEN result.enforced = true THEN result.distance END DESC,  // Enforced: distance DESC
@@ -216,267 +598,430 @@ class BloodHoundConnector:
                 result.firstGPLinkId DESC  // GPLink ID DESC
 
                 // Debug : RETURN result.node.name AS gpo_order, result.enforced AS enforced, result.firstGPLinkId AS first_gpLink_id, result.distance
-                RETURN result.node AS n
+                RETURN """ + projection("g", GPO_PROPERTIES) + """ AS n
                 """
 
-        return self.query(query, params)
+        return self.query(query, params, name="get_gpo_inheritance")
 
-    def containers_affected_by_gpo(self, gpo_guid, domain_sid):
+    def get_domain_topology(self, domain_sid):
         """
-        Get not empty containers that are affected by a GPO
+        Stream the containers of a domain with their parent container, GPLinks and if they contain users or computers
         """
-        params = {"gpo_guid": gpo_guid, "domain_sid": domain_sid}
+        params = {"domain_sid": domain_sid.upper()}
         query = """
-                MATCH (g:GPO)
-                WHERE toUpper(g.gpcpath) CONTAINS toUpper($gpo_guid) and toUpper(g.domainsid) = toUpper($domain_sid)
-                WITH g
+                MATCH (n:Base {domainsid: $domain_sid})
+                WHERE n:Container OR n:OU OR n:Domain
+                RETURN n.objectid AS objectid, n.name AS name, n.distinguishedname AS distinguishedname,
+                       n.domainsid AS domainsid, n.blocksinheritance AS blocksinheritance,
+                       CASE WHEN n:Domain THEN 'Domain' WHEN n:OU THEN 'OU' ELSE 'Container' END AS type,
+                       HEAD([(p)-[:Contains]->(n) WHERE p:Container OR p:OU OR p:Domain | p.objectid]) AS parent,
+                       SIZE([(n)-[:Contains]->(l) WHERE l:Computer OR l:User | 1]) > 0 AS notempty,
+                       [(g:GPO)-[r:GPLink]->(n) | {
+                           objectid: g.objectid, name: g.name, guid: g.gpohound_guid, gpcpath: g.gpcpath,
+                           domainsid: g.domainsid, enforced: r.enforced, link_id: ID(r)
+                       }] AS gplinks
+                """
 
-                // Collect direct GPLinks first
-                OPTIONAL MATCH (g:GPO)-[r1:GPLink]->(c)-[r2:Contains]->(t)
-                WHERE ANY(label IN labels(c) WHERE label IN ['Container','OU', 'Domain'])
-                AND ANY(label IN labels(t) WHERE label IN ['User','Computer'])
-                WITH g, COLLECT(DISTINCT c) as directContainer
+        return self.stream(query, params, name="get_domain_topology")
 
-                // Collect indirect GPLinks
-                OPTIONAL MATCH p2 = (g:GPO)-[r3:GPLink]-()-[r4:Contains*1..]->(c)-[r5:Contains]->(t)
-                WHERE ( 
-                    ((NONE(x IN TAIL(TAIL(NODES(p2))) WHERE x.blocksinheritance = true AND 'OU' IN LABELS(x))) OR r3.enforced = true)
-                    AND ANY(label IN labels(c) WHERE label IN ['Container','OU', 'Domain'])
-                    AND ANY(label IN labels(t) WHERE label IN ['User','Computer'])
-                ) 
-                WITH directContainer, COLLECT(DISTINCT c) AS indirectContainer
-                WITH directContainer + indirectContainer AS AllContainers
-                UNWIND AllContainers AS n
-                RETURN n
+    def get_domain_computers(self, domain_sid):
+        """
+        Stream the computers directly contained in the containers of a domain
+        """
+        params = {"domain_sid": domain_sid.upper()}
+        query = """
+                MATCH (c:Base {domainsid: $domain_sid})-[:Contains]->(n:Computer)
+                WHERE c:Container OR c:OU OR c:Domain
+                RETURN c.objectid AS container, n.objectid AS objectid, n.name AS name,
+                       n.samaccountname AS samaccountname, n.distinguishedname AS distinguishedname,
+                       n.domainsid AS domainsid
                 """
 
-        return self.query(query, params)
+        return self.stream(query, params, name="get_domain_computers")
 
-    def machines_affected_by_gpo(self, gpo_guid, domain_sid):
+    def get_domain_memberships(self, domain_sid):
         """
-        Get machines that are affected by a GPO
+        Stream the MemberOf relationships to the groups of a domain
         """
-        params = {"gpo_guid": gpo_guid, "domain_sid": domain_sid}
+        params = {"domain_sid": domain_sid.upper()}
         query = """
-                MATCH (g:GPO)
-                WHERE toUpper(g.gpcpath) CONTAINS toUpper($gpo_guid) and toUpper(g.domainsid) = toUpper($domain_sid)
-                WITH g
-
-                // Collect machines from direct GPLink OU first
-                OPTIONAL MATCH (g:GPO)-[r1:GPLink]->(c)-[r2:Contains]->(t:Computer)
-                WHERE ANY(label IN labels(c) WHERE label IN ['Container','OU', 'Domain'])
-                WITH g, t as directMachines
-
-                // Collect machines from indirect GPLink OU
-                OPTIONAL MATCH p2 = (g:GPO)-[r3:GPLink]-()-[r4:Contains*1..]->(c)-[r5:Contains]->(t:Computer)
-                WHERE ((NONE(x IN TAIL(TAIL(NODES(p2))) WHERE x.blocksinheritance = true AND 'OU' IN LABELS(x))) OR r3.enforced = true)
-                AND ANY(label IN labels(c) WHERE label IN ['Container','OU', 'Domain'])
-
-                WITH directMachines, t AS indirectMachines
-                WITH collect(directMachines) + collect(indirectMachines) AS AllMachines
-                UNWIND AllMachines AS n
-                RETURN DISTINCT n
+                MATCH (m:Base)-[:MemberOf]->(g:Group {domainsid: $domain_sid})
+                RETURN m.objectid AS member, g.objectid AS group,
+                       CASE WHEN m:User THEN 'User' WHEN m:Computer THEN 'Computer' WHEN m:Group THEN 'Group' END
+                       AS member_type
                 """
 
-        return self.query(query, params)
+        return self.stream(query, params, name="get_domain_memberships")
 
-    def machines_in_container(self, objectid, domain_sid):
+    def find_trustees(self, domain_sid, trustee_sids):
         """
-        Get machines that are affected by a GPO
+        Find the trustees of a domain, well-known SIDs are matched with their domain prefixed objectids
         """
-        params = {"objectid": objectid, "domain_sid": domain_sid}
+        params = {"trustee_ids": self.trustee_objectids(trustee_sids), "domain_sid": domain_sid.upper()}
         query = """
-                MATCH (c)-[:Contains]->(n:Computer)
-                WHERE ANY(label IN labels(c) WHERE label IN ['Container','OU', 'Domain'])
-                AND toUpper(c.objectid) = toUpper($objectid) AND toUpper(c.domainsid) = toUpper($domain_sid)
-                RETURN n
+                UNWIND $trustee_ids AS trustee_id
+                MATCH (n:Base {objectid: trustee_id})
+                WHERE n.domainsid = $domain_sid
+                RETURN n.objectid AS objectid, n.samaccountname AS samaccountname,
+                       CASE WHEN n:User THEN 'User' WHEN n:Computer THEN 'Computer' ELSE 'Group' END AS type
                 """
 
-        return self.query(query, params)
+        return self.stream(query, params, name="find_trustees")
+
+    def partition_rows(self, rows):
+        """
+        Split write rows into "write_concurrency" partitions by target computer.
+        All the rows of a computer are in the same partition, so concurrent partitions never write the same computer.
+        """
+        partition_of = {}
+        for row in rows:
+            partition_of.setdefault(row.get("computer"), len(partition_of) % self.write_concurrency)
+
+        partitions = [[] for _ in range(min(self.write_concurrency, len(partition_of)))]
+        for row in rows:
+            partitions[partition_of[row.get("computer")]].append(row)
+        return partitions
 
-    def get_containers(self, domain_sid):
+    @staticmethod
+    def run_write(tx, query_str, params):
+        """
+        Unit of work of a managed write transaction
         """
-        Get all containers of a domain
+        return tx.run(query_str, params).consume()
+
+    def write_partition(self, name, query_str, rows):
         """
-        params = {"domain_sid": domain_sid}
+        Write rows by batches of "write_batch_size" in one session.
+        Each batch is a managed transaction, retried by the driver on transient errors (deadlocks, lock timeouts),
+        and logged in the checkpoint once committed.
+        """
+        with self.driver.session(**self.session_config) as session:
+            for start in range(0, len(rows), self.write_batch_size):
+                batch = rows[start : start + self.write_batch_size]
+
+                # Batches written before an interruption are skipped
+                batch_key = self.checkpoint.batch_key(query_str, batch) if self.checkpoint else None
+                if batch_key and self.checkpoint.is_written(batch_key):
+                    continue
+
+                begin = time.perf_counter()
+                session.execute_write(self.run_write, query_str, {"rows": batch})
+                self.query_stats.record(name, time.perf_counter() - begin, 1)
+
+                if batch_key:
+                    self.checkpoint.log_batch(batch_key)
+
+    def get_enrichment_edges(self, domain_sid):
+        """
+        Stream the relationships added by GPOHound to the computers of a domain
+        """
+        params = {"domain_sid": domain_sid.upper()}
         query = """
-                MATCH (n) 
-                WHERE n.domainsid = $domain_sid 
-                AND ANY(label IN labels(n) WHERE label IN ['Container','OU', 'Domain'])
-                RETURN DISTINCT n
+                MATCH (t:Base)-[r {gpohound: true}]->(c:Computer {domainsid: $domain_sid})
+                RETURN t.objectid AS trustee, c.objectid AS computer, type(r) AS edge
                 """
 
-        return self.query(query, params)
+        return self.stream(query, params, name="get_enrichment_edges")
 
-    def get_not_empty_containers(self, domain_sid):
+    def get_derived_edges(self, domain_sid):
         """
-        Get all not empty containers
+        Stream the effective access relationships derived by GPOHound to the computers of a domain
         """
-        params = {"domain_sid": domain_sid}
+        params = {"domain_sid": domain_sid.upper()}
         query = """
-                MATCH (n)-[r:Contains]->(l) 
-                WHERE ANY(label IN labels(n) WHERE label IN ['Container','OU', 'Domain'])
-                AND ANY(label IN labels(l) WHERE label IN ['Computer','User'])
-                AND n.domainsid = $domain_sid 
-                RETURN DISTINCT n
+                MATCH (t:Base)-[r {gpohound_derived: true}]->(c:Computer {domainsid: $domain_sid})
+                RETURN t.objectid AS trustee, c.objectid AS computer, type(r) AS edge
                 """
-        return self.query(query, params)
 
-    def add_edge(self, domain_sid, trustee_sid, computer_objectid, edge):
+        return self.stream(query, params, name="get_derived_edges")
+
+    def get_local_group_members(self, domain_sid):
         """
-        Add a single edge between a trustee and a computer.
+        Stream the members of the local groups of the computers of a domain, and if GPOHound added them
         """
+        params = {"domain_sid": domain_sid.upper()}
+        query = """
+                MATCH (g:ADLocalGroup)-[:LocalToComputer]->(c:Computer {domainsid: $domain_sid})
+                MATCH (t:Base)-[r:MemberOfLocalGroup]->(g)
+                RETURN t.objectid AS trustee, c.objectid AS computer, g.objectid AS group_id,
+                    coalesce(r.gpohound, false) AS gpohound
+                """
 
-        params = {
-            "trustee_sid": trustee_sid,
-            "domain_sid": domain_sid,
-            "computer_objectid": computer_objectid,
-            "edge": edge,
-        }
+        return self.stream(query, params, name="get_local_group_members")
 
+    def get_computer_properties(self, domain_sid, keys):
+        """
+        Stream the values of some properties on the computers of a domain
+        """
+        params = {"domain_sid": domain_sid.upper(), "keys": list(keys)}
         query = """
-                MATCH (t)
-                WHERE t.objectid IS NOT NULL
-                AND toUpper(t.objectid) = $trustee_sid
-                AND toUpper(t.domainsid) = $domain_sid
-                MATCH (c:Computer {objectid: $computer_objectid})
-                CALL apoc.merge.relationship(t, $edge, {gpohound:true}, {}, c) YIELD rel
-                RETURN t, c
+                UNWIND $keys AS key
+                MATCH (c:Computer {domainsid: $domain_sid})
+                WHERE c[key] IS NOT NULL
+                RETURN c.objectid AS computer, key, c[key] AS value
                 """
 
-        return self.query(query, params)
+        return self.stream(query, params, name="get_computer_properties")
 
-    def add_edges(self, domain_sid, container_ids, trustee_sids, edge):
+    def write_batches(self, statement, rows, name="write_batches"):
+        """
+        Run a write statement for each "row" of the rows :
+            - by default, UNWIND queries of "write_batch_size" rows, one managed transaction per query,
+              written by "write_concurrency" sessions partitioned by computer
+            - with chunked writes, one query committing every "write_batch_size" rows on the database side,
+              with apoc.periodic.iterate if APOC is available or CALL { } IN TRANSACTIONS
+        """
+        if not rows:
+            return
+
+        if not self.chunked_writes:
+            self.query_memo.clear()
+
+            query = "UNWIND $rows AS row\n" + statement + "\nRETURN count(*) AS count"
+            partitions = self.partition_rows(rows)
+            if len(partitions) == 1:
+                self.write_partition(name, query, partitions[0])
+            else:
+                with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+                    futures = [
+                        executor.submit(self.write_partition, name, query, partition) for partition in partitions
+                    ]
+                    for future in futures:
+                        future.result()
+
+        elif self.apoc:
+            params = {
+                "iterate": "UNWIND $rows AS row RETURN row",
+                "action": statement + "\nRETURN count(*) AS count",
+                "batch_size": self.write_batch_size,
+                "rows": rows,
+            }
+            query = """
+                    CALL apoc.periodic.iterate($iterate, $action, {batchSize: $batch_size, params: {rows: $rows}})
+                    YIELD batches, failedBatches, errorMessages
+                    RETURN batches, failedBatches, errorMessages
+                    """
+            result = self.query(query, params, write=True, name=name)
+            if result and result["failedBatches"]:
+                logging.error("%s batches failed to be written: %s", result["failedBatches"], result["errorMessages"])
+
+        else:
+            # The batch size can not be a parameter on every Neo4j version
+            query = (
+                "UNWIND $rows AS row\nCALL {\nWITH row\n"
+                + statement
+                + f"\n}} IN TRANSACTIONS OF {int(self.write_batch_size)} ROWS"
+            )
+            self.query(query, {"rows": rows}, write=True, name=name)
+
+    def delete_in_batches(self, query_str, params, name="delete_in_batches"):
+        """
+        Run a query deleting at most "$batch_size" items and returning their "count" until nothing is left
+        Returns the number of deleted items
+        """
+        params = dict(params, batch_size=self.write_batch_size)
+
+        total = 0
+        while True:
+            result = self.query(query_str, params, write=True, name=name)
+            count = result["count"] if result else 0
+            total += count
+            if count:
+                logging.info("%s: %s removed", name, total)
+            if count < self.write_batch_size:
+                return total
+
+    @staticmethod
+    def computer_filter(domain_sid=None, computers=None, *conditions):
         """
-        Add relationship between a trustee and machines from a container
+        WHERE clause of a cleanup with its conditions, limited to the computers "c" of a domain or to some computers
         """
-        params = {
-            "edge": edge,
-            "container_ids": container_ids,
-            "trustee_sids": trustee_sids,
-            "domain_sid": domain_sid.upper(),
-        }
+        conditions = list(conditions)
+        if domain_sid:
+            conditions.append("c.domainsid = $domain_sid")
+        if computers is not None:
+            conditions.append("c.objectid IN $computers")
+        return "WHERE " + " AND ".join(conditions) if conditions else ""
+
+    def cleanup_edges(self, domain_sid=None, computers=None):
+        """
+        Delete the relationships added or derived by GPOHound to computers
+        """
+        params = {"domain_sid": (domain_sid or "").upper(), "computers": computers}
+        query = f"""
+                MATCH (:Base)-[r]->(c:Computer)
+                {self.computer_filter(domain_sid, computers, "(r.gpohound = true OR r.gpohound_derived = true)")}
+                WITH r LIMIT $batch_size
+                DELETE r
+                RETURN count(*) AS count
+                """
 
-        query = """
-                // Collect all computers from all containers
-                UNWIND $container_ids AS container_id
-                MATCH (o {objectid: container_id})-[:Contains]->(c:Computer)
-                WITH collect(DISTINCT c) AS computers
-
-                // Match all trustees
-                MATCH (t)
-                WHERE t.objectid IS NOT NULL
-                AND ANY(sid IN $trustee_sids WHERE toUpper(t.objectid) ENDS WITH sid)
-                AND toUpper(t.domainsid) = $domain_sid
-                
-                // Merge relationships
-                UNWIND computers AS c
-                CALL apoc.merge.relationship(t, $edge, {gpohound: true}, {}, c) YIELD rel
-
-                RETURN t, c
+        return self.delete_in_batches(query, params, name="cleanup_edges")
+
+    def cleanup_local_groups(self, domain_sid=None, computers=None):
+        """
+        Delete the local group memberships added by GPOHound, then the local groups it created which have no member left
+        """
+        params = {"domain_sid": (domain_sid or "").upper(), "computers": computers}
+        query = f"""
+                MATCH (:Base)-[r:MemberOfLocalGroup {{gpohound: true}}]->(g:ADLocalGroup)
+                MATCH (g)-[:LocalToComputer]->(c:Computer)
+                {self.computer_filter(domain_sid, computers)}
+                WITH r LIMIT $batch_size
+                DELETE r
+                RETURN count(*) AS count
+                """
+        memberships = self.delete_in_batches(query, params, name="cleanup_local_groups")
+
+        query = f"""
+                MATCH (g:ADLocalGroup {{gpohound: true}})-[:LocalToComputer]->(c:Computer)
+                {self.computer_filter(domain_sid, computers, "NOT EXISTS { MATCH (:Base)-[:MemberOfLocalGroup]->(g) }")}
+                WITH DISTINCT g LIMIT $batch_size
+                DETACH DELETE g
+                RETURN count(*) AS count
                 """
+        groups = self.delete_in_batches(query, params, name="cleanup_local_groups")
 
-        return self.query(query, params)
+        return memberships, groups
 
-    def add_edge_bhce(self, domain_sid, trustee_sid, computer_objectid, group_sid, group_name):
+    def cleanup_properties(self, keys, domain_sid=None, computers=None):
         """
-        Add a single trustee to a single computer's local group (BloodHound CE style).
+        Remove the properties added by GPOHound to computers
         """
-        trustee_sid = trustee_sid.upper()
-        domain_sid = domain_sid.upper()
-        group_name = group_name.upper()
+        keys = [key for key in keys if key]
+        if not keys:
+            return 0
+
+        params = {"domain_sid": (domain_sid or "").upper(), "computers": computers, "keys": keys}
+        query = f"""
+                MATCH (c:Computer)
+                {self.computer_filter(domain_sid, computers, "any(key IN $keys WHERE c[key] IS NOT NULL)")}
+                WITH c LIMIT $batch_size
+                REMOVE {", ".join("c." + property_key(key) for key in keys)}
+                RETURN count(*) AS count
+                """
 
-        params = {
-            "trustee_sid": trustee_sid,
-            "domain_sid": domain_sid,
-            "computer_objectid": computer_objectid,
-            "group_rid": group_sid.split("-")[-1],
-            "group_name": group_name,
-        }
+        return self.delete_in_batches(query, params, name="cleanup_properties")
 
-        query = """
-                // Match the trustee
-                MATCH (t)
-                WHERE t.objectid IS NOT NULL
-                AND toUpper(t.objectid) = $trustee_sid
-                AND toUpper(t.domainsid) = $domain_sid
+    def merge_edges(self, rows, derived=False):
+        """
+        Merge relationships between trustees and computers, rows : {trustee, computer, edge}
+        One statement per relationship type, checked before being written in the statement
+        Derived relationships are marked with "gpohound_derived" instead of "gpohound"
+        """
+        marker = "gpohound_derived" if derived else "gpohound"
+        for edge, edge_rows in group_rows(rows, "edge").items():
+            if not RELATIONSHIP_TYPE.match(edge):
+                logging.error("Invalid relationship type '%s', %s relationships skipped", edge, len(edge_rows))
+                continue
 
-                // Match the computer
-                MATCH (c:Computer {objectid: $computer_objectid})
+            statement = f"""
+                    MATCH (t:Base {{objectid: row.trustee}})
+                    MATCH (c:Computer {{objectid: row.computer}})
+                    MERGE (t)-[:{edge} {{{marker}: true}}]->(c)
+                    """
 
-                // Merge the local group
-                MERGE (g:ADLocalGroup {objectid: toUpper(c.objectid + '-' + $group_rid)})
-                ON CREATE SET g.name = $group_name + '@' + c.name
+            self.write_batches(statement, edge_rows, name="merge_edges")
 
-                // Merge relationships
-                MERGE (t)-[:MemberOfLocalGroup]->(g)
-                MERGE (g)-[:LocalToComputer]->(c)
+    def delete_edges(self, rows, derived=False):
+        """
+        Delete relationships added by GPOHound, rows : {trustee, computer, edge}
+        """
+        marker = "gpohound_derived" if derived else "gpohound"
+        for edge, edge_rows in group_rows(rows, "edge").items():
+            if not RELATIONSHIP_TYPE.match(edge):
+                logging.error("Invalid relationship type '%s', %s relationships skipped", edge, len(edge_rows))
+                continue
 
-                RETURN t, c
-                """
+            statement = f"""
+                    MATCH (t:Base {{objectid: row.trustee}})
+                    MATCH (t)-[r:{edge} {{{marker}: true}}]->(c:Computer {{objectid: row.computer}})
+                    DELETE r
+                    """
 
-        return self.query(query, params)
+            self.write_batches(statement, edge_rows, name="delete_edges")
 
-    def add_edges_bhce(self, domain_sid, container_ids, trustee_sids, group_sid, group_name):
+    def merge_local_groups(self, rows):
         """
-        Add relationships between a trustee, a local group and machines from a container for BloodHound CE.
+        Add trustees to the local groups of computers for BloodHound CE, rows : {trustee, computer, group_id, name}
         The naming follows SharpHound's convention: "GROUPNAME@COMPUTERNAME" in uppercase.
         Each computer has its own local groups, with "objectid" values in the format: COMPUTER_SID-GROUP_RID
+        The groups are created first, then the memberships, both matching the groups through the uniqueness constraint.
+        The groups and memberships created by GPOHound are marked with "gpohound" for "db cleanup".
         """
+        if not rows:
+            return
 
-        params = {
-            "container_ids": container_ids,
-            "trustee_sids": trustee_sids,
-            "domain_sid": domain_sid.upper(),
-            "group_rid": group_sid.split("-")[-1],
-            "group_name": group_name.upper(),
-        }
+        self.ensure_constraints()
 
-        query = """
-                // Expand all containers and collect computers
-                UNWIND $container_ids AS container_id
-                MATCH (o {objectid: container_id})-[:Contains]->(c:Computer)
-                WITH collect(DISTINCT c) AS computers
-
-                // Match all trustees
-                MATCH (t)
-                WHERE t.objectid IS NOT NULL
-                AND toUpper(t.objectid) IN $trustee_sids
-                AND toUpper(t.domainsid) = $domain_sid
-                UNWIND computers AS c
-                WITH t, c
-
-                // Local group per computer
-                WITH t, c, toUpper(c.objectid + '-' + $group_rid) AS local_group_id
-                MERGE (g:ADLocalGroup {objectid: local_group_id})
-                ON CREATE SET g.name = $group_name + '@' + c.name
-                WITH t, g, c
-                
-                // Relationships
-                CALL apoc.merge.relationship(t, 'MemberOfLocalGroup', {}, {}, g) YIELD rel AS rel1
-                CALL apoc.merge.relationship(g, 'LocalToComputer', {}, {}, c) YIELD rel AS rel2
-
-                RETURN t, c
+        groups = {}
+        for row in rows:
+            groups.setdefault(
+                row["group_id"], {"group_id": row["group_id"], "name": row["name"], "computer": row["computer"]}
+            )
+
+        statement = """
+                MATCH (c:Computer {objectid: row.computer})
+                MERGE (g:ADLocalGroup {objectid: row.group_id})
+                ON CREATE SET g.name = row.name, g.gpohound = true
+                MERGE (g)-[:LocalToComputer]->(c)
                 """
-        return self.query(query, params)
 
-    def add_extra_property(self, container_ids, property_key, property_value):
+        self.write_batches(statement, list(groups.values()), name="merge_local_groups")
+
+        statement = """
+                MATCH (t:Base {objectid: row.trustee})
+                MATCH (g:ADLocalGroup {objectid: row.group_id})
+                MERGE (t)-[r:MemberOfLocalGroup]->(g)
+                ON CREATE SET r.gpohound = true
+                """
+
+        members = [
+            {"trustee": row["trustee"], "group_id": row["group_id"], "computer": row["computer"]} for row in rows
+        ]
+        self.write_batches(statement, members, name="merge_local_groups")
+
+    def delete_local_groups(self, rows):
         """
-        Add property to a machine in a container
+        Delete local group memberships added by GPOHound, rows : {trustee, computer, group_id}
+        then the local groups it created which have no member left
         """
+        if not rows:
+            return
 
-        params = {
-            "container_ids": container_ids,
-            "property_key": property_key,
-            "property_value": property_value,
-        }
+        statement = """
+                MATCH (t:Base {objectid: row.trustee})
+                MATCH (t)-[r:MemberOfLocalGroup {gpohound: true}]->(g:ADLocalGroup {objectid: row.group_id})
+                DELETE r
+                """
 
-        query = """
-                UNWIND $container_ids AS container_id
-                MATCH (o {objectid: container_id})-[:Contains]->(c:Computer)
-                WITH c
-                CALL apoc.create.setProperty(c, $property_key, $property_value)
-                YIELD node AS n
-                RETURN n
+        self.write_batches(statement, rows, name="delete_local_groups")
+
+        groups = {}
+        for row in rows:
+            groups.setdefault(row["group_id"], {"group_id": row["group_id"], "computer": row["computer"]})
+
+        statement = """
+                MATCH (g:ADLocalGroup {objectid: row.group_id})
+                WHERE g.gpohound = true AND NOT EXISTS { MATCH (:Base)-[:MemberOfLocalGroup]->(g) }
+                DETACH DELETE g
                 """
-        return self.query(query, params)
+
+        self.write_batches(statement, list(groups.values()), name="delete_local_groups")
+
+    def set_properties(self, rows):
+        """
+        Set properties on computers, rows : {computer, key, value}
+        One statement per property key, quoted in the statement
+        """
+        for key, key_rows in group_rows(rows, "key").items():
+            if not key:
+                logging.error("Empty property key, %s properties skipped", len(key_rows))
+                continue
+
+            statement = f"""
+                    MATCH (c:Computer {{objectid: row.computer}})
+                    SET c.{property_key(key)} = row.value
+                    """
+
+            self.write_batches(statement, key_rows, name="set_properties")
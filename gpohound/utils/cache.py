@@ -0,0 +1,400 @@
+import os
+import json
+import logging
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from platformdirs import user_cache_dir
+
+
+class ResolutionCache:
+    """
+    Persistent store for names resolved with BloodHound (SID <-> name, domain <-> SID, NetBIOS -> domain, GUID -> GPO name)
+
+    Entries are scoped to a fingerprint of the BloodHound database, so importing a new collection invalidates them
+    """
+
+    # Returned by "get" when a key was never resolved (None is a valid cached value)
+    MISSING = object()
+
+    # Mappings of other BloodHound databases are kept until they are unused for too long or too many
+    MAX_AGE_DAYS = 30
+    MAX_FINGERPRINTS = 8
+
+    def __init__(self, fingerprint, path=None):
+        if path is None:
+            cache_dir = user_cache_dir("gpohound")
+            os.makedirs(cache_dir, exist_ok=True)
+            path = os.path.join(cache_dir, "resolution.sqlite")
+
+        self.path = path
+        self.fingerprint = fingerprint
+        self.entries = {}
+
+        self.database = sqlite3.connect(self.path)
+        self.database.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mappings (
+                fingerprint TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                PRIMARY KEY (fingerprint, kind, key)
+            )
+            """
+        )
+
+        self.database.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                fingerprint TEXT NOT NULL PRIMARY KEY,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self.database.execute(
+            "INSERT OR REPLACE INTO fingerprints (fingerprint, last_used) VALUES (?, ?)",
+            (self.fingerprint, time.time()),
+        )
+        self.prune()
+        self.database.commit()
+
+        # Load the mappings of the current collection
+        rows = self.database.execute("SELECT kind, key, value FROM mappings WHERE fingerprint = ?", (self.fingerprint,))
+        for kind, key, value in rows:
+            self.entries[(kind, key)] = value
+
+        logging.debug("Loaded %s cached resolutions from %s", len(self.entries), self.path)
+
+    def prune(self):
+        """
+        Drop the mappings of the BloodHound databases unused for MAX_AGE_DAYS, and of the least recently used ones
+        beyond MAX_FINGERPRINTS, the mappings of the current database are always kept
+        """
+
+        # Mappings stored before the fingerprints were tracked are dated from now
+        self.database.execute(
+            """
+            INSERT OR IGNORE INTO fingerprints (fingerprint, last_used)
+            SELECT DISTINCT fingerprint, ? FROM mappings
+            """,
+            (time.time(),),
+        )
+
+        stale = {
+            fingerprint
+            for (fingerprint,) in self.database.execute(
+                "SELECT fingerprint FROM fingerprints WHERE last_used < ? AND fingerprint != ?",
+                (time.time() - self.MAX_AGE_DAYS * 86400, self.fingerprint),
+            )
+        }
+        stale.update(
+            fingerprint
+            for (fingerprint,) in self.database.execute(
+                "SELECT fingerprint FROM fingerprints WHERE fingerprint != ? ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                (self.fingerprint, self.MAX_FINGERPRINTS - 1),
+            )
+        )
+
+        for fingerprint in stale:
+            self.database.execute("DELETE FROM mappings WHERE fingerprint = ?", (fingerprint,))
+            self.database.execute("DELETE FROM fingerprints WHERE fingerprint = ?", (fingerprint,))
+
+        if stale:
+            logging.debug("Dropped the cached resolutions of %s previous BloodHound databases", len(stale))
+
+    @staticmethod
+    def compute_fingerprint(data):
+        """
+        Hash the data describing a BloodHound database
+        """
+        serialized = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, kind, key):
+        """
+        Get a cached value, returns MISSING if the key was never resolved
+        """
+        return self.entries.get((kind, key), self.MISSING)
+
+    def set(self, kind, key, value):
+        """
+        Cache a resolved value
+        """
+        if self.entries.get((kind, key), self.MISSING) == value:
+            return
+
+        self.entries[(kind, key)] = value
+        self.database.execute(
+            "INSERT OR REPLACE INTO mappings (fingerprint, kind, key, value) VALUES (?, ?, ?, ?)",
+            (self.fingerprint, kind, key, value),
+        )
+
+    def close(self):
+        """
+        Persist the new entries and close the store
+        """
+        if self.database:
+            self.database.commit()
+            self.database.close()
+            self.database = None
+
+
+class EnrichmentCheckpoint:
+    """
+    Persistent enrichment plans, state of each domain and log of the written batches, to resume an interrupted
+    enrichment
+
+    Like the resolution cache, the checkpoints are scoped to a fingerprint of the BloodHound database
+    """
+
+    TABLES = {
+        "plans": ("fingerprint", "domain", "plan", "done"),
+        "batches": ("fingerprint", "domain", "key"),
+    }
+
+    def __init__(self, fingerprint, path=None):
+        if path is None:
+            cache_dir = user_cache_dir("gpohound")
+            os.makedirs(cache_dir, exist_ok=True)
+            path = os.path.join(cache_dir, "checkpoint.sqlite")
+
+        self.path = path
+        self.fingerprint = fingerprint
+
+        # Domain being written and its batches written by a previous run
+        self.domain = None
+        self.written = set()
+
+        # Batches are logged by the concurrent writers
+        self.lock = threading.Lock()
+
+        self.database = sqlite3.connect(self.path, check_same_thread=False)
+
+        # Checkpoints of a previous layout can't be resumed
+        for table, columns in self.TABLES.items():
+            existing = [row[1] for row in self.database.execute(f"PRAGMA table_info({table})")]
+            if existing and tuple(existing) != columns:
+                logging.debug("Dropping the enrichment checkpoints of a previous version")
+                self.database.execute(f"DROP TABLE {table}")
+
+        self.database.execute(
+            """
+            CREATE TABLE IF NOT EXISTS plans (
+                fingerprint TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                plan TEXT NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (fingerprint, domain)
+            )
+            """
+        )
+        self.database.execute(
+            """
+            CREATE TABLE IF NOT EXISTS batches (
+                fingerprint TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                key TEXT NOT NULL,
+                PRIMARY KEY (fingerprint, domain, key)
+            )
+            """
+        )
+
+        # Drop the checkpoints of previous BloodHound collections
+        self.database.execute("DELETE FROM plans WHERE fingerprint != ?", (self.fingerprint,))
+        self.database.execute("DELETE FROM batches WHERE fingerprint != ?", (self.fingerprint,))
+        self.database.commit()
+
+    @staticmethod
+    def batch_key(query_str, rows):
+        """
+        Hash of a write query and the rows of one of its batches
+        """
+        serialized = json.dumps([query_str, rows], sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def domains(self, done):
+        """
+        Domains with an enrichment plan entirely written or not
+        """
+        rows = self.database.execute(
+            "SELECT domain FROM plans WHERE fingerprint = ? AND done = ? ORDER BY domain", (self.fingerprint, int(done))
+        )
+        return [domain for (domain,) in rows]
+
+    def pending_domains(self):
+        """
+        Domains with an enrichment plan not entirely written
+        """
+        return self.domains(done=False)
+
+    def done_domains(self):
+        """
+        Domains entirely written
+        """
+        return self.domains(done=True)
+
+    def save_plan(self, domain, plan):
+        """
+        Store the enrichment plan of a domain before writing it, the batches of the domain logged by a previous run
+        are dropped
+        """
+        with self.lock:
+            self.database.execute(
+                "DELETE FROM batches WHERE fingerprint = ? AND domain = ?", (self.fingerprint, domain)
+            )
+            self.database.execute(
+                "INSERT OR REPLACE INTO plans (fingerprint, domain, plan, done) VALUES (?, ?, ?, 0)",
+                (self.fingerprint, domain, json.dumps(plan)),
+            )
+            self.database.commit()
+
+    def load_plan(self, domain):
+        """
+        Get the stored enrichment plan of a domain
+        """
+        row = self.database.execute(
+            "SELECT plan FROM plans WHERE fingerprint = ? AND domain = ?", (self.fingerprint, domain)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def begin(self, domain):
+        """
+        Start writing a domain, with the batches it already has written
+        """
+        with self.lock:
+            self.domain = domain
+            self.written = {
+                key
+                for (key,) in self.database.execute(
+                    "SELECT key FROM batches WHERE fingerprint = ? AND domain = ?", (self.fingerprint, domain)
+                )
+            }
+
+    def is_written(self, key):
+        """
+        Check if a batch of the domain being written was written by a previous run
+        """
+        return key in self.written
+
+    def log_batch(self, key):
+        """
+        Log a written batch of the domain being written, committed right away so that it survives an interruption
+        """
+        with self.lock:
+            self.written.add(key)
+            self.database.execute(
+                "INSERT OR IGNORE INTO batches (fingerprint, domain, key) VALUES (?, ?, ?)",
+                (self.fingerprint, self.domain, key),
+            )
+            self.database.commit()
+
+    def finish(self, domain):
+        """
+        Mark a domain as entirely written, its plan is kept for the output of a resumed run
+        """
+        with self.lock:
+            self.database.execute(
+                "UPDATE plans SET done = 1 WHERE fingerprint = ? AND domain = ?", (self.fingerprint, domain)
+            )
+            self.database.execute(
+                "DELETE FROM batches WHERE fingerprint = ? AND domain = ?", (self.fingerprint, domain)
+            )
+            self.database.commit()
+            self.domain = None
+            self.written = set()
+
+    def clear(self):
+        """
+        Drop all the checkpoints, when a run starts over
+        """
+        with self.lock:
+            self.domain = None
+            self.written = set()
+            self.database.execute("DELETE FROM plans WHERE fingerprint = ?", (self.fingerprint,))
+            self.database.execute("DELETE FROM batches WHERE fingerprint = ?", (self.fingerprint,))
+            self.database.commit()
+
+    def close(self):
+        """
+        Close the store
+        """
+        if self.database:
+            self.database.close()
+            self.database = None
+
+
+class QueryMemo:
+    """
+    Bounded LRU memo of read query results, keyed by the connector method and the query parameters.
+    Cleared when a query writes to the database.
+    """
+
+    # Returned by "get" when a query was not run (None is a valid result)
+    MISSING = object()
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+
+    @staticmethod
+    def key(name, query_str, params):
+        """
+        Hashable key of a query, the lists and dictionaries of the parameters are converted to tuples
+        """
+
+        def normalize(value):
+            if isinstance(value, (list, tuple)):
+                return tuple(normalize(item) for item in value)
+            if isinstance(value, dict):
+                return tuple(sorted((key, normalize(item)) for key, item in value.items()))
+            return value
+
+        return (name, query_str, normalize(params))
+
+    def get(self, key):
+        """
+        Get a memoized result, returns MISSING if the query was not run
+        """
+        if not self.size:
+            return self.MISSING
+
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.hits[key[0]] = self.hits.get(key[0], 0) + 1
+            return self.results[key]
+
+        self.misses[key[0]] = self.misses.get(key[0], 0) + 1
+        return self.MISSING
+
+    def set(self, key, value):
+        """
+        Memoize a result, the least recently used result is dropped when the memo is full
+        """
+        if not self.size:
+            return
+
+        self.results[key] = value
+        self.results.move_to_end(key)
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop the results after a write
+        """
+        self.results.clear()
+
+    def log_summary(self):
+        """
+        Log the hit rate of each query in debug output
+        """
+        for name in sorted(set(self.hits) | set(self.misses)):
+            hits = self.hits.get(name, 0)
+            total = hits + self.misses.get(name, 0)
+            logging.debug("Query memo %s: %s/%s hits (%.0f%%)", name, hits, total, 100 * hits / total)
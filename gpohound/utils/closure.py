@@ -0,0 +1,120 @@
+class MembershipClosure:
+    """
+    Transitive members of the groups of a domain, computed in memory from its MemberOf relationships loaded once.
+    Nested groups are condensed into strongly connected components, so membership cycles are handled,
+    and the members of each component are computed once.
+    """
+
+    def __init__(self, rows):
+        self.direct = {}
+        self.types = {}
+        self.component = {}
+        self.closures = []
+        self.member_counts = {}
+
+        for row in rows:
+            self.direct.setdefault(row["group"], []).append(row["member"])
+            self.types[row["member"]] = row.get("member_type")
+            self.types.setdefault(row["group"], "Group")
+
+    def resolve(self, root):
+        """
+        Compute the members of the components reachable from a group, with Tarjan's algorithm without recursion.
+        The components are found in reverse topological order, so the members of a component are computed
+        after the members of the groups it contains.
+        """
+        if root in self.component or root not in self.direct:
+            return
+
+        index = {root: 0}
+        lowlink = {root: 0}
+        stack = [root]
+        on_stack = {root}
+        work = [(root, iter(self.direct[root]))]
+
+        while work:
+            node, children = work[-1]
+
+            for child in children:
+                # Accounts and groups without members, or groups already resolved
+                if child not in self.direct or child in self.component:
+                    continue
+
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(self.direct[child])))
+                    break
+
+                if child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    self.close(component)
+
+    def close(self, component):
+        """
+        Members of a component : the members of its groups and the members of the components they contain
+        """
+        component_id = len(self.closures)
+        for group in component:
+            self.component[group] = component_id
+
+        members = set()
+        for group in component:
+            for member in self.direct[group]:
+                members.add(member)
+                if member in self.direct and self.component[member] != component_id:
+                    members |= self.closures[self.component[member]]
+
+        self.closures.append(frozenset(members))
+
+    def members(self, objectid):
+        """
+        Transitive members of a group, without the group itself
+        """
+        if objectid not in self.direct:
+            return frozenset()
+
+        self.resolve(objectid)
+        return self.closures[self.component[objectid]] - {objectid}
+
+    def effective_members(self, objectid, types=("User", "Computer")):
+        """
+        Transitive members of a group which are accounts
+        """
+        return {member for member in self.members(objectid) if self.types.get(member) in types}
+
+    def counts(self, objectid):
+        """
+        Number of users and computers an account or a group stands for, None if the object has no known membership
+        """
+        if objectid not in self.member_counts:
+            object_type = self.types.get(objectid)
+            if object_type in ("User", "Computer"):
+                counts = {"users": int(object_type == "User"), "computers": int(object_type == "Computer")}
+            elif object_type == "Group":
+                members = self.members(objectid)
+                counts = {
+                    "users": sum(1 for member in members if self.types.get(member) == "User"),
+                    "computers": sum(1 for member in members if self.types.get(member) == "Computer"),
+                }
+            else:
+                counts = None
+            self.member_counts[objectid] = counts
+
+        return self.member_counts[objectid]
@@ -0,0 +1,465 @@
+import io
+import json
+import logging
+import zipfile
+import hashlib
+from contextlib import contextmanager
+
+from gpohound.utils.bloodhound import normalize_guid
+from gpohound.utils.bloodhound import DOMAIN_PROPERTIES, GPO_PROPERTIES, ACCOUNT_PROPERTIES, CONTAINER_PROPERTIES
+
+# Collector files loaded in the in-memory graph and the label of their objects
+COLLECTOR_FILES = {
+    "domains": "Domain",
+    "ous": "OU",
+    "containers": "Container",
+    "gpos": "GPO",
+    "computers": "Computer",
+    "users": "User",
+    "groups": "Group",
+}
+
+# Node properties kept in memory
+NODE_PROPERTIES = (
+    "name",
+    "domain",
+    "domainsid",
+    "distinguishedname",
+    "samaccountname",
+    "gpcpath",
+    "blocksinheritance",
+    "netbios",
+)
+
+CONTAINER_LABELS = ("Container", "OU", "Domain")
+
+
+def iter_json_data(file, chunk_size=1 << 20):
+    """
+    Iterate over the objects of the "data" array of a collector JSON file without loading the whole file
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    # Find the beginning of the "data" array
+    while True:
+        start = buffer.find('"data"')
+        if start != -1:
+            array = buffer.find("[", start)
+            if array != -1:
+                position = array + 1
+                break
+        if eof:
+            return
+        read_more()
+
+    while True:
+        # Skip separators
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+
+        if position >= len(buffer):
+            if eof:
+                return
+            read_more()
+            continue
+
+        if buffer[position] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Incomplete object, read the next chunk
+            if eof:
+                raise
+            read_more()
+            continue
+
+        position = end
+        yield item
+
+
+class OfflineBloodHoundConnector:
+    """
+    BloodHound data loaded from a collector zip file in memory.
+    Presents the read interface of BloodHoundConnector without a Neo4j database.
+    """
+
+    offline = True
+    query_stats = None
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.apoc = False
+        self.prepared = True
+        self.accounts_prepared = True
+        self.connection = False
+
+        # Nodes and labels by objectid
+        self.nodes = {}
+        self.labels = {}
+
+        # Adjacency lists
+        self.contains = {}
+        self.contained_by = {}
+        self.gplinks = {}
+        self.member_of = {}
+
+        # Lookup indexes
+        self.by_domain_name = {}
+        self.by_gpo_guid = {}
+        self.by_samaccountname = {}
+        self.by_distinguishedname = {}
+        self.by_name = {}
+
+        try:
+            self.load(zip_path)
+            self.connection = True
+        except (OSError, zipfile.BadZipFile, json.JSONDecodeError, UnicodeDecodeError) as error:
+            logging.error("Could not load the BloodHound zip file '%s': %s", zip_path, error)
+
+    def load(self, zip_path):
+        """
+        Stream the collector files of the zip into the in-memory indexes
+        """
+
+        with zipfile.ZipFile(zip_path) as archive:
+            for file_name in archive.namelist():
+                data_type = file_name.rsplit(".", 1)[0].rsplit("_", 1)[-1].lower()
+                label = COLLECTOR_FILES.get(data_type)
+                if not file_name.lower().endswith(".json") or not label:
+                    continue
+
+                with archive.open(file_name) as raw_file:
+                    file = io.TextIOWrapper(raw_file, encoding="utf-8-sig")
+                    count = 0
+                    for item in iter_json_data(file):
+                        self.add_object(item, label)
+                        count += 1
+
+                logging.debug("Loaded %s objects from %s", count, file_name)
+
+    def add_object(self, item, label):
+        """
+        Add a collected object, its properties and its relationships
+        """
+
+        objectid = item.get("ObjectIdentifier", "").upper()
+        if not objectid:
+            return
+
+        properties = item.get("Properties") or {}
+        node = {key: properties[key] for key in NODE_PROPERTIES if properties.get(key) is not None}
+        node["objectid"] = objectid
+
+        self.nodes[objectid] = node
+        self.labels[objectid] = label
+
+        # Lookup indexes
+        if node.get("distinguishedname"):
+            self.by_distinguishedname[node["distinguishedname"].upper()] = objectid
+        if node.get("name"):
+            self.by_name.setdefault(node["name"].upper(), objectid)
+        if label == "Domain" and node.get("domain"):
+            self.by_domain_name[node["domain"].upper()] = objectid
+        if label == "GPO" and "{" in node.get("gpcpath", ""):
+            guid = normalize_guid(node["gpcpath"].split("{", 1)[1].split("}")[0])
+            self.by_gpo_guid[(guid, node.get("domainsid", "").upper())] = objectid
+        if label in ("User", "Group", "Computer") and node.get("samaccountname"):
+            key = (node.get("domainsid", "").upper(), node["samaccountname"].upper())
+            self.by_samaccountname[key] = objectid
+
+        # Contains
+        for child in item.get("ChildObjects") or []:
+            child_id = child.get("ObjectIdentifier", "").upper()
+            if child_id:
+                self.contains.setdefault(objectid, []).append(child_id)
+                self.contained_by[child_id] = objectid
+
+        # GPLink, in the order of the links
+        for link in item.get("Links") or []:
+            gpo_id = (link.get("GUID") or "").upper()
+            if gpo_id:
+                self.gplinks.setdefault(objectid, []).append((gpo_id, bool(link.get("IsEnforced"))))
+
+        # MemberOf
+        for member in item.get("Members") or []:
+            member_id = member.get("ObjectIdentifier", "").upper()
+            if member_id:
+                self.member_of.setdefault(member_id, []).append(objectid)
+
+    def result(self, objectids, properties):
+        """
+        Format nodes like the records returned by BloodHoundConnector.query, with the same property projections
+        """
+        records = []
+        for objectid in objectids:
+            node = self.nodes.get(objectid, {"objectid": objectid})
+            records.append({"n": {prop: node.get(prop) for prop in properties}})
+
+        if records:
+            if len(records) == 1:
+                return records[0]
+            else:
+                return records
+        return None
+
+    def is_container(self, objectid):
+        """
+        Check if an object is a Domain, an OU or a Container
+        """
+        return self.labels.get(objectid) in CONTAINER_LABELS
+
+    def is_not_empty(self, objectid):
+        """
+        Check if a container contains at least one user or computer
+        """
+        return any(self.labels.get(child) in ("User", "Computer") for child in self.contains.get(objectid, []))
+
+    def blocks_inheritance(self, objectid):
+        """
+        Check if an OU blocks inheritance
+        """
+        return self.labels.get(objectid) == "OU" and self.nodes[objectid].get("blocksinheritance") is True
+
+    @contextmanager
+    def read_transaction(self):
+        """
+        Nothing to group, the data is in memory
+        """
+        yield
+
+    def close(self):
+        pass
+
+    def fingerprint(self):
+        """
+        Hash of the zip file
+        """
+        digest = hashlib.sha256()
+        with open(self.zip_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        return {"zip": digest.hexdigest()}
+
+    def find_domains(self):
+        """
+        Find all domains
+        """
+        domains = [objectid for objectid, label in self.labels.items() if label == "Domain"]
+        return self.result(domains, DOMAIN_PROPERTIES)
+
+    def find_by_domain_name(self, domain):
+        """
+        Find domain by by domain name
+        """
+        objectid = self.by_domain_name.get(domain.upper())
+        return self.result([objectid] if objectid else [], DOMAIN_PROPERTIES)
+
+    def find_by_gpo_guid(self, gpo_guid, domain_sid):
+        """
+        Find a GPO with his GUID and domain SID
+        """
+        objectid = self.by_gpo_guid.get((normalize_guid(gpo_guid), domain_sid.upper()))
+        return self.result([objectid] if objectid else [], GPO_PROPERTIES)
+
+    def get_gpos(self, domain_sid):
+        """
+        Stream the GUID and name of all the GPOs of a domain
+        """
+        for (guid, gpo_domain_sid), objectid in self.by_gpo_guid.items():
+            if gpo_domain_sid == domain_sid.upper():
+                gpo = self.nodes[objectid]
+                yield {"guid": guid, "gpcpath": gpo.get("gpcpath"), "name": gpo.get("name")}
+
+    def find_by_samaccountname(self, samaccountname, domain_sid):
+        """
+        Find an object with a samaccountname
+        """
+        objectid = self.by_samaccountname.get((domain_sid.upper(), samaccountname.upper()))
+        return self.result([objectid] if objectid else [], ACCOUNT_PROPERTIES)
+
+    def all_samaccountnames(self):
+        """
+        Stream all the sAMAccountName with their objectid
+        """
+        for (_, samaccountname), objectid in self.by_samaccountname.items():
+            yield {"samaccountname": self.nodes[objectid].get("samaccountname", samaccountname), "objectid": objectid}
+
+    def find_by_objectid(self, objectid):
+        """
+        Find an object by his objectid
+        """
+        objectid = objectid.upper()
+        return self.result([objectid] if objectid in self.nodes else [], ACCOUNT_PROPERTIES)
+
+    def trustee_objectids(self, trustee_sids):
+        """
+        Get the objectids of trustees, BloodHound prefixes well-known SIDs with the domain name (DOMAIN.LOCAL-S-1-5-32-544)
+        """
+        domain_names = [self.nodes[objectid].get("name", "").upper() for objectid in self.by_domain_name.values()]
+
+        objectids = []
+        for sid in trustee_sids:
+            sid = sid.upper()
+            objectids.append(sid)
+            if not sid.startswith("S-1-5-21-"):
+                objectids.extend(f"{domain_name}-{sid}" for domain_name in domain_names if domain_name)
+
+        return objectids
+
+    def find_trustees(self, domain_sid, trustee_sids):
+        """
+        Stream the objectid, sAMAccountName and type of the trustees of a domain
+        """
+        for objectid in self.trustee_objectids(trustee_sids):
+            node = self.nodes.get(objectid)
+            if node and node.get("domainsid", "").upper() == domain_sid.upper():
+                label = self.labels[objectid]
+                yield {
+                    "objectid": objectid,
+                    "samaccountname": node.get("samaccountname"),
+                    "type": label if label in ("User", "Computer") else "Group",
+                }
+
+    def get_domain_memberships(self, domain_sid):
+        """
+        Stream the MemberOf relationships to the groups of a domain
+        """
+        for member, groups in self.member_of.items():
+            for group in groups:
+                if self.nodes.get(group, {}).get("domainsid", "").upper() == domain_sid.upper():
+                    member_type = self.labels.get(member)
+                    yield {
+                        "member": member,
+                        "group": group,
+                        "member_type": member_type if member_type in ("User", "Computer", "Group") else None,
+                    }
+
+    def find_container(self, target):
+        """
+        Find a container with a attribut of the container
+        """
+        target = target.upper()
+        objectid = self.by_distinguishedname.get(target, target)
+        return self.result([objectid] if self.is_container(objectid) else [], CONTAINER_PROPERTIES)
+
+    def find_trustee_container(self, target):
+        """
+        Find the container of a trustee
+        """
+        target = target.upper()
+        for objectid in (self.by_distinguishedname.get(target), target, self.by_name.get(target)):
+            if objectid and self.labels.get(objectid) in ("User", "Computer"):
+                container_id = self.contained_by.get(objectid)
+                if container_id and self.is_container(container_id):
+                    return self.result([container_id], CONTAINER_PROPERTIES)
+        return None
+
+    def get_gpo_inheritance(self, objectid):
+        """
+        Get GPO application order for a container, with the same ordering as the Neo4j query
+        """
+        objectid = objectid.upper()
+        if objectid not in self.nodes:
+            return None
+
+        # Ancestors with their distance and if an OU between them and the container blocks the inheritance
+        ancestors = [(objectid, 0, False)]
+        blocked = self.blocks_inheritance(objectid)
+        parent = self.contained_by.get(objectid)
+        distance = 1
+        while parent and parent not in [ancestor[0] for ancestor in ancestors]:
+            ancestors.append((parent, distance, blocked))
+            blocked = blocked or self.blocks_inheritance(parent)
+            parent = self.contained_by.get(parent)
+            distance += 1
+
+        # Blocked inheritance is ignored for containers and domains, as in the Neo4j query
+        check_blocking = self.labels.get(objectid) not in ("Container", "Domain")
+        links = []
+        for container_id, container_distance, container_blocked in ancestors:
+            for link_index, (gpo_id, enforced) in enumerate(self.gplinks.get(container_id, [])):
+                if container_distance and container_blocked and not enforced and check_blocking:
+                    continue
+                links.append((gpo_id, enforced, container_distance + 1, link_index))
+
+        # Enforced first (distance DESC), then non-enforced (distance ASC), then GPLink order DESC
+        links.sort(key=lambda link: (not link[1], -link[2] if link[1] else link[2], -link[3]))
+        return self.result([link[0] for link in links], GPO_PROPERTIES)
+
+    def domain_containers(self, domain_sid):
+        """
+        Iterate over the containers of a domain
+        """
+        for objectid, label in self.labels.items():
+            if label in CONTAINER_LABELS and self.nodes[objectid].get("domainsid", "").upper() == domain_sid.upper():
+                node = self.nodes[objectid]
+                yield {
+                    "objectid": objectid,
+                    "name": node.get("name"),
+                    "distinguishedname": node.get("distinguishedname"),
+                    "domainsid": node.get("domainsid"),
+                    "blocksinheritance": node.get("blocksinheritance"),
+                }
+
+    def get_domain_topology(self, domain_sid):
+        """
+        Stream the containers of a domain with their parent container, GPLinks and if they contain users or computers
+        """
+        for container in self.domain_containers(domain_sid):
+            objectid = container["objectid"]
+            parent = self.contained_by.get(objectid)
+
+            gplinks = []
+            for link_id, (gpo_id, enforced) in enumerate(self.gplinks.get(objectid, [])):
+                gpo = self.nodes.get(gpo_id, {"objectid": gpo_id})
+                gplinks.append(
+                    {
+                        "objectid": gpo_id,
+                        "name": gpo.get("name"),
+                        "gpcpath": gpo.get("gpcpath"),
+                        "domainsid": gpo.get("domainsid"),
+                        "enforced": enforced,
+                        "link_id": link_id,
+                    }
+                )
+
+            container.update(
+                {
+                    "type": self.labels[objectid],
+                    "parent": parent if self.is_container(parent) else None,
+                    "notempty": self.is_not_empty(objectid),
+                    "gplinks": gplinks,
+                }
+            )
+            yield container
+
+    def get_domain_computers(self, domain_sid):
+        """
+        Stream the computers directly contained in the containers of a domain
+        """
+        for container in self.domain_containers(domain_sid):
+            for child in self.contains.get(container["objectid"], []):
+                if self.labels.get(child) == "Computer":
+                    machine = self.nodes[child]
+                    yield {
+                        "container": container["objectid"],
+                        "objectid": child,
+                        "name": machine.get("name"),
+                        "samaccountname": machine.get("samaccountname"),
+                        "distinguishedname": machine.get("distinguishedname"),
+                        "domainsid": machine.get("domainsid"),
+                    }
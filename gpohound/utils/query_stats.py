@@ -0,0 +1,105 @@
+import re
+import math
+import logging
+import threading
+
+
+class QueryStats:
+    """
+    Calls, latency and returned rows of the BloodHound queries, grouped by the connector method running them.
+    With profiling, the PROFILE plan of the first execution of each query shape is kept.
+    """
+
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.queries = {}
+        self.plans = {}
+
+        # Enrichment writes are recorded from several threads
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def shape(query_str):
+        """
+        Query text without the formatting, used to identify a query shape
+        """
+        return re.sub(r"\s+", " ", query_str).strip()
+
+    def should_profile(self, query_str, write=False):
+        """
+        Check if the query shape must be profiled, schema and write queries are never profiled
+        """
+        if not self.profile or write or self.shape(query_str) in self.plans:
+            return False
+
+        # Reserve the shape, concurrent queries of the same shape are not profiled again
+        self.plans[self.shape(query_str)] = None
+        return True
+
+    def record(self, name, duration, rows):
+        """
+        Record the execution of a query
+        """
+        with self.lock:
+            stats = self.queries.setdefault(name, {"durations": [], "rows": 0})
+            stats["durations"].append(duration)
+            stats["rows"] += rows
+
+    def record_plan(self, name, query_str, profile):
+        """
+        Keep the database hits and rows of a PROFILE plan
+        """
+
+        def total_hits(operator):
+            return operator.get("dbHits", 0) + sum(total_hits(child) for child in operator.get("children", []))
+
+        if profile:
+            self.plans[self.shape(query_str)] = {
+                "name": name,
+                "db_hits": total_hits(profile),
+                "rows": profile.get("rows", 0),
+                "operator": profile.get("operatorType"),
+            }
+
+    @staticmethod
+    def percentile(durations, percent):
+        """
+        Nearest-rank percentile of sorted durations
+        """
+        index = max(math.ceil(len(durations) * percent / 100) - 1, 0)
+        return durations[index]
+
+    def summary(self):
+        """
+        Statistics by query, the slowest in total first
+        """
+        summary = []
+        for name, stats in self.queries.items():
+            durations = sorted(stats["durations"])
+            summary.append(
+                {
+                    "query": name,
+                    "calls": len(durations),
+                    "total": sum(durations),
+                    "p50": self.percentile(durations, 50),
+                    "p99": self.percentile(durations, 99),
+                    "rows": stats["rows"],
+                }
+            )
+
+        return sorted(summary, key=lambda stats: stats["total"], reverse=True)
+
+    def log_summary(self):
+        """
+        Log the statistics in debug output
+        """
+        for stats in self.summary():
+            logging.debug(
+                "Query %s: %s calls, %.3fs total, p50 %.1fms, p99 %.1fms, %s rows",
+                stats["query"],
+                stats["calls"],
+                stats["total"],
+                stats["p50"] * 1000,
+                stats["p99"] * 1000,
+                stats["rows"],
+            )
@@ -0,0 +1,179 @@
+from gpohound.utils.bloodhound import normalize_guid
+
+
+class DomainTopology:
+    """
+    Domain, OU and Container tree of a domain with its GPLinks, loaded once to compute GPO scopes in memory
+    """
+
+    def __init__(self, rows):
+        self.containers = {}
+        self.types = {}
+        self.parents = {}
+        self.not_empty = set()
+        self.gplinks = {}
+        self.children = {}
+        self.roots = []
+        self.machines = None
+        self.enforced_chains = {}
+        self.inherited_chains = {}
+
+        for row in rows:
+            objectid = row["objectid"]
+            links = []
+            for link in row.get("gplinks") or []:
+                guid = link.get("guid")
+                if not guid and "{" in (link.get("gpcpath") or ""):
+                    guid = link["gpcpath"].split("{", 1)[1].split("}")[0]
+                links.append(
+                    {
+                        "guid": normalize_guid(guid) if guid else None,
+                        "domainsid": (link.get("domainsid") or "").upper(),
+                        "enforced": link.get("enforced") is True,
+                        "link_id": link.get("link_id") or 0,
+                        "gpo": {
+                            key: link.get(key)
+                            for key in ("objectid", "name", "gpcpath", "domainsid")
+                            if link.get(key) is not None
+                        },
+                    }
+                )
+
+            # Links of a container are applied by GPLink ID DESC
+            links.sort(key=lambda link: link["link_id"], reverse=True)
+
+            self.containers[objectid] = {
+                "objectid": objectid,
+                "name": row.get("name"),
+                "distinguishedname": row.get("distinguishedname"),
+                "domainsid": row.get("domainsid"),
+                "blocksinheritance": row.get("blocksinheritance"),
+            }
+            self.types[objectid] = row.get("type")
+            self.parents[objectid] = row.get("parent")
+            self.gplinks[objectid] = links
+            if row.get("notempty"):
+                self.not_empty.add(objectid)
+
+        for objectid, parent in self.parents.items():
+            if parent in self.containers and parent != objectid:
+                self.children.setdefault(parent, []).append(objectid)
+            else:
+                self.roots.append(objectid)
+
+    def blocks_inheritance(self, objectid):
+        """
+        Check if a container is an OU blocking inheritance
+        """
+        return self.types[objectid] == "OU" and self.containers[objectid]["blocksinheritance"] is True
+
+    def affected_containers(self):
+        """
+        Compute the not empty containers affected by every GPO linked in the domain with one walk of the tree.
+        Returns a {(gpo_guid, gpo_domain_sid): [container, ...]} dictionary, direct links first then inherited links.
+        """
+        direct = {}
+        indirect = {}
+
+        # Walk each tree with the links inherited from the ancestors, blocked links are dropped under blocking OUs
+        stack = [(root, ()) for root in reversed(self.roots)]
+        visited = set()
+        while stack:
+            objectid, inherited = stack.pop()
+            if objectid in visited:
+                continue
+            visited.add(objectid)
+
+            container = self.containers[objectid]
+            links = self.gplinks[objectid]
+            if self.blocks_inheritance(objectid):
+                inherited = tuple(link for link in inherited if link[1])
+
+            if objectid in self.not_empty:
+                for link in links:
+                    if not link["guid"]:
+                        continue
+                    key = (link["guid"], link["domainsid"])
+                    direct.setdefault(key, {})[objectid] = container
+                for key, _ in inherited:
+                    indirect.setdefault(key, {})[objectid] = container
+
+            children_links = inherited + tuple(
+                ((link["guid"], link["domainsid"]), link["enforced"]) for link in links if link["guid"]
+            )
+            for child in reversed(self.children.get(objectid, [])):
+                stack.append((child, children_links))
+
+        affected = {}
+        for key in set(direct) | set(indirect):
+            # Same as the Neo4j query, a container can be both directly and indirectly linked
+            affected[key] = list(direct.get(key, {}).values()) + list(indirect.get(key, {}).values())
+
+        return affected
+
+    def ancestors(self, objectid):
+        """
+        Get the ancestors of a container, from the root to the container itself
+        """
+        chain = []
+        while objectid in self.containers and objectid not in chain:
+            chain.append(objectid)
+            objectid = self.parents[objectid]
+        return list(reversed(chain))
+
+    def enforced_chain(self, objectid):
+        """
+        Enforced links applying to a container, the farthest first
+        """
+        if objectid not in self.enforced_chains:
+            for ancestor in self.ancestors(objectid):
+                if ancestor not in self.enforced_chains:
+                    parent = self.parents[ancestor]
+                    self.enforced_chains[ancestor] = self.enforced_chains.get(parent, ()) + tuple(
+                        link["gpo"] for link in self.gplinks[ancestor] if link["enforced"]
+                    )
+        return self.enforced_chains[objectid]
+
+    def inherited_chain(self, objectid, blocking=True):
+        """
+        Non-enforced links applying to a container, the nearest first.
+        With blocking, the links of the ancestors are dropped under an OU blocking inheritance
+        """
+        if (objectid, blocking) not in self.inherited_chains:
+            for ancestor in self.ancestors(objectid):
+                if (ancestor, blocking) not in self.inherited_chains:
+                    own = tuple(link["gpo"] for link in self.gplinks[ancestor] if not link["enforced"])
+                    if blocking and self.blocks_inheritance(ancestor):
+                        self.inherited_chains[(ancestor, blocking)] = own
+                    else:
+                        parent = self.parents[ancestor]
+                        self.inherited_chains[(ancestor, blocking)] = own + self.inherited_chains.get(
+                            (parent, blocking), ()
+                        )
+        return self.inherited_chains[(objectid, blocking)]
+
+    def gpo_inheritance(self, objectid):
+        """
+        GPO application order of a container: enforced links first (farthest first), then the other links (nearest first).
+        Blocked inheritance is ignored for containers and domains, as in the Neo4j query
+        """
+        if objectid not in self.containers:
+            return None
+
+        blocking = self.types[objectid] not in ("Container", "Domain")
+        return [dict(gpo) for gpo in self.enforced_chain(objectid) + self.inherited_chain(objectid, blocking)]
+
+    def load_machines(self, rows):
+        """
+        Load the computers directly contained in the containers of the domain
+        """
+        self.machines = {}
+        for row in rows:
+            container = row.pop("container")
+            self.machines.setdefault(container, []).append(row)
+
+    def machines_in_container(self, objectid):
+        """
+        Computers directly contained in a container
+        """
+        return [dict(machine) for machine in self.machines.get(objectid, [])]
@@ -400,9 +400,15 @@ def print_analysed(analysed):
                         table_trustees = Table(show_lines=True, expand=True)
                         table_trustees.add_column("SID", ratio=10, justify="center")
                         table_trustees.add_column("Name", ratio=8, justify="center")
+                        effective = any(member.get("effective") for member in priv_data.get("trustees", []))
+                        if effective:
+                            table_trustees.add_column("Effective", ratio=6, justify="center")
 
                         for member in priv_data.get("trustees", []):
-                            table_trustees.add_row(member.get("sid"), member.get("name"))
+                            row = [member.get("sid"), member.get("name")]
+                            if effective:
+                                row.append(format_effective(member.get("effective")))
+                            table_trustees.add_row(*row)
 
                         # Table for analysis
                         table_privilege = Table(show_lines=True, width=int(table_output_width() * 0.79))
@@ -429,9 +435,15 @@ def print_analysed(analysed):
                         table_members = Table(show_lines=True, expand=True)
                         table_members.add_column("SID", ratio=10, justify="center")
                         table_members.add_column("Trustee", ratio=8, justify="center")
+                        effective = any(member.get("effective") for member in group.get("Members", []))
+                        if effective:
+                            table_members.add_column("Effective", ratio=6, justify="center")
 
                         for member in group.get("Members", []):
-                            table_members.add_row(member.get("sid"), member.get("name"))
+                            row = [member.get("sid"), member.get("name")]
+                            if effective:
+                                row.append(format_effective(member.get("effective")))
+                            table_members.add_row(*row)
 
                         # Table for analysis
                         table_group = Table(show_lines=True, width=int(table_output_width() * 0.85))
@@ -510,6 +522,15 @@ def print_analysed(analysed):
     console.print(tree)
 
 
+def format_effective(effective):
+    """
+    Users and computers a trustee gives access to
+    """
+    if not effective:
+        return ""
+    return f"{effective['users']} user(s)\n{effective['computers']} computer(s)"
+
+
 def print_enriched(output_enrichment):
     """
     Print enrichement results
@@ -587,3 +608,44 @@ def print_enriched(output_enrichment):
     enriched_to_tree(output_enrichment, tree, depth=0)
     console = Console()
     console.print(tree)
+
+
+def print_query_report(query_stats):
+    """
+    Print the statistics and PROFILE plans of the BloodHound queries
+    """
+
+    console = Console(stderr=True)
+
+    stats_table = Table(title="BloodHound queries", show_lines=True)
+    stats_table.add_column("Query", justify="left")
+    stats_table.add_column("Calls", justify="right")
+    stats_table.add_column("Total (s)", justify="right")
+    stats_table.add_column("p50 (ms)", justify="right")
+    stats_table.add_column("p99 (ms)", justify="right")
+    stats_table.add_column("Rows", justify="right")
+
+    for stats in query_stats.summary():
+        stats_table.add_row(
+            stats["query"],
+            str(stats["calls"]),
+            f"{stats['total']:.3f}",
+            f"{stats['p50'] * 1000:.1f}",
+            f"{stats['p99'] * 1000:.1f}",
+            str(stats["rows"]),
+        )
+    console.print(stats_table)
+
+    plans = sorted(
+        (plan for plan in query_stats.plans.values() if plan), key=lambda plan: plan["db_hits"], reverse=True
+    )
+    if plans:
+        plans_table = Table(title="PROFILE of the first execution of each query shape", show_lines=True)
+        plans_table.add_column("Query", justify="left")
+        plans_table.add_column("DB hits", justify="right")
+        plans_table.add_column("Rows", justify="right")
+        plans_table.add_column("Root operator", justify="left")
+
+        for plan in plans:
+            plans_table.add_row(plan["name"], str(plan["db_hits"]), str(plan["rows"]), str(plan["operator"]))
+        console.print(plans_table)
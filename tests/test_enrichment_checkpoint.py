@@ -0,0 +1,174 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gpohound.enricher import BloodHoundEnricher
+from gpohound.parser import GPOParser
+from gpohound.utils.bloodhound import BloodHoundConnector
+from gpohound.utils.cache import EnrichmentCheckpoint, QueryMemo
+from gpohound.utils.query_stats import QueryStats
+from gpohound.utils.utils import load_yaml_config
+
+
+class Interrupted(Exception):
+    """
+    Database going down during the enrichment
+    """
+
+
+class FakeDriver:
+    """
+    Driver recording the written batches, raising after "fail_after" batches
+    """
+
+    def __init__(self):
+        self.written = []
+        self.fail_after = None
+
+    def session(self, **_):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def execute_write(self, work, query_str, params):
+        if self.fail_after is not None and len(self.written) >= self.fail_after:
+            raise Interrupted()
+        self.written.append(params["rows"][0]["computer"])
+
+
+def connector(checkpoint):
+    """
+    BloodHound connector writing one row per batch to the fake driver
+    """
+    bloodhound = BloodHoundConnector.__new__(BloodHoundConnector)
+    bloodhound.driver = FakeDriver()
+    bloodhound.session_config = {}
+    bloodhound.query_memo = QueryMemo(0)
+    bloodhound.query_stats = QueryStats()
+    bloodhound.write_batch_size = 1
+    bloodhound.write_concurrency = 1
+    bloodhound.chunked_writes = False
+    bloodhound.checkpoint = checkpoint
+    bloodhound.constraints_ensured = True
+    return bloodhound
+
+
+def plan(domain, computers):
+    """
+    Enrichment rows of a domain with one AdminTo relationship per computer
+    """
+    return {
+        "edges": [{"trustee": f"{domain}-USER", "computer": computer, "edge": "AdminTo"} for computer in computers],
+        "local_groups": [],
+        "properties": [],
+        "stale_edges": [],
+        "derived_edges": [],
+        "stale_derived_edges": [],
+        "output": {"Memberships": {}, "Privilege Rights": {}, "Properties": []},
+    }
+
+
+class EnrichmentCheckpointTest(unittest.TestCase):
+    """
+    Resume an enrichment of two domains interrupted while writing the second one
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "checkpoint.sqlite")
+        self.plans = {
+            "north.local": plan("north.local", [f"NORTH-{idx}" for idx in range(4)]),
+            "south.local": plan("south.local", [f"SOUTH-{idx}" for idx in range(6)]),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def interrupted_run(self):
+        """
+        Write the first domain, then stop after two batches of the second one
+        """
+        checkpoint = EnrichmentCheckpoint("fingerprint", self.path)
+        bloodhound = connector(checkpoint)
+        enricher = BloodHoundEnricher(bloodhound, None)
+
+        for domain, rows in self.plans.items():
+            if domain == "south.local":
+                bloodhound.driver.fail_after = len(bloodhound.driver.written) + 2
+            checkpoint.save_plan(domain, rows)
+            try:
+                enricher.write(domain, rows)
+            except Interrupted:
+                break
+
+        checkpoint.close()
+        return bloodhound.driver.written
+
+    def test_resume_writes_only_the_remaining_batches(self):
+        first_run = self.interrupted_run()
+        self.assertEqual(first_run, ["NORTH-0", "NORTH-1", "NORTH-2", "NORTH-3", "SOUTH-0", "SOUTH-1"])
+
+        checkpoint = EnrichmentCheckpoint("fingerprint", self.path)
+        self.assertEqual(checkpoint.done_domains(), ["north.local"])
+        self.assertEqual(checkpoint.pending_domains(), ["south.local"])
+
+        bloodhound = connector(checkpoint)
+        enricher = BloodHoundEnricher(bloodhound, None)
+
+        # The finished domain is not written again, its output comes from the stored plan
+        self.assertEqual(enricher.completed("north.local"), enricher.load_output(self.plans["north.local"]["output"]))
+        enricher.resume("south.local")
+
+        self.assertEqual(bloodhound.driver.written, ["SOUTH-2", "SOUTH-3", "SOUTH-4", "SOUTH-5"])
+        self.assertEqual(checkpoint.pending_domains(), [])
+        self.assertEqual(checkpoint.done_domains(), ["north.local", "south.local"])
+        checkpoint.close()
+
+    def test_failed_local_groups_keep_the_domain_pending(self):
+        checkpoint = EnrichmentCheckpoint("fingerprint", self.path)
+        bloodhound = connector(checkpoint)
+        enricher = BloodHoundEnricher(bloodhound, None)
+
+        rows = plan("north.local", ["NORTH-0"])
+        rows["local_groups"] = [
+            {"trustee": "north.local-USER", "computer": "NORTH-0", "group_id": "NORTH-0-544", "name": "ADMINISTRATORS"}
+        ]
+        bloodhound.driver.fail_after = 1
+        checkpoint.save_plan("north.local", rows)
+
+        with self.assertRaises(Interrupted):
+            enricher.write("north.local", rows)
+
+        self.assertEqual(checkpoint.done_domains(), [])
+        self.assertEqual(checkpoint.pending_domains(), ["north.local"])
+        checkpoint.close()
+
+    def test_save_plan_keeps_the_batches_of_other_domains(self):
+        self.interrupted_run()
+
+        checkpoint = EnrichmentCheckpoint("fingerprint", self.path)
+        checkpoint.save_plan("east.local", plan("east.local", ["EAST-0"]))
+        checkpoint.begin("south.local")
+        self.assertEqual(len(checkpoint.written), 2)
+        checkpoint.close()
+
+    def test_finished_domains_are_not_parsed(self):
+        policy_files = list(load_yaml_config("config", "gpo_files.yaml").values())
+        sysvol = os.path.join(os.path.dirname(os.path.dirname(__file__)), "example")
+
+        parser = GPOParser(policy_files)
+        parser.parse_domain_policies(sysvol)
+        self.assertTrue(parser.policies.get("north.sevenkingdoms.local"))
+
+        parser = GPOParser(policy_files)
+        parser.parse_domain_policies(sysvol, ["north.sevenkingdoms.local"])
+        self.assertEqual(parser.policies, {"north.sevenkingdoms.local": {}})
+
+
+if __name__ == "__main__":
+    unittest.main()